@@ -1,10 +1,23 @@
 #!/usr/bin/python
 import os
+import sys
 import json
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from elasticsearch import Elasticsearch, NotFoundError
 
+# the helpers in packages/db/migration_utils are shared with the other
+# scripts of packages/db
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migration_utils.metrics import metrics
+from migration_utils.profiling import DRY_RUN, PROFILE, PROFILE_SAMPLE_SIZE, explain, print_plan, print_projection
+
+from batching import batch_rows
+from bulk_indexer import ES_BULK_BYTES, ES_BULK_SIZE, ES_BULK_THREADS, BulkIndexer
+from index_lifecycle import (create_bulk_index, delete_bulk_index, finish_bulk_index, live_index_settings, reindex_from_alias,
+                             swap_alias, versioned_index_name)
+
 PG_HOST = os.getenv('PG_HOST', 'localhost')
 PG_PORT = os.getenv('PG_PORT', 5432)
 PG_USER = os.getenv('PG_USER', 'app_user')
@@ -15,8 +28,49 @@ ES_USERNAME = os.getenv('ES_USERNAME', 'elastic')
 ES_PASSWORD = os.getenv('ES_PASSWORD', 'password')
 UPDATE_TIME = os.getenv('UPDATE_TIME', '2019-01-01 00:00:00')
 INDEX_SETTINGS = os.getenv('INDEX_SETTINGS', 'index_settings.json')
+# pages fetched per round trip of the server side cursor
+CURSOR_ITERSIZE = os.getenv('CURSOR_ITERSIZE', 500)
+# reindex into a new index with the new mappings and swap pages_alias over
+# instead of changing the mappings of the live index
+REINDEX = os.getenv('REINDEX', 'false') == 'true' or '--reindex' in sys.argv
 DATETIME_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"'
 
+PAGES_QUERY = f'''
+    SELECT DISTINCT
+        elastic_page_id as "pageId"
+    FROM omnivore.highlight
+    WHERE
+        elastic_page_id IS NOT NULL
+        AND deleted = false
+        AND created_at > '{UPDATE_TIME}'
+'''
+
+# all highlights of a page in one row, streamed in page order
+HIGHLIGHTS_BY_PAGE_QUERY = f'''
+    SELECT
+        elastic_page_id as "pageId",
+        json_agg(json_build_object(
+            'id', id,
+            'quote', quote,
+            'prefix', prefix,
+            'createdAt', to_char(created_at, '{DATETIME_FORMAT}'),
+            'updatedAt', to_char(COALESCE(updated_at, current_timestamp), '{DATETIME_FORMAT}'),
+            'suffix', suffix,
+            'patch', patch,
+            'annotation', annotation,
+            'shortId', short_id,
+            'userId', user_id,
+            'sharedAt', to_char(shared_at, '{DATETIME_FORMAT}')
+        ) ORDER BY created_at) as highlights
+    FROM omnivore.highlight
+    WHERE
+        elastic_page_id IS NOT NULL
+        AND deleted = false
+        AND created_at > '{UPDATE_TIME}'
+    GROUP BY elastic_page_id
+    ORDER BY elastic_page_id
+'''
+
 
 def update_mappings(client: Elasticsearch):
     print('updating mappings')
@@ -32,8 +86,44 @@ def update_mappings(client: Elasticsearch):
         exit(1)
 
 
-def assertData(conn, client: Elasticsearch, pages):
-    # get all users from postgres
+def reindex_with_mappings(client: Elasticsearch):
+    # returns the new index and the settings to restore once it is loaded.
+    # writes to the live index after the reindex started are not copied,
+    # run it while the api is not writing or rerun with UPDATE_TIME
+    index = None
+    try:
+        with open(INDEX_SETTINGS, 'r') as f:
+            settings = json.load(f)
+        restored = live_index_settings(client, 'pages_alias', settings)
+        index = versioned_index_name('pages')
+        create_bulk_index(client, index, settings)
+        reindex_from_alias(client, 'pages_alias', index)
+        return index, restored
+    except Exception as err:
+        print('reindex ERROR:', err)
+        if index is not None:
+            discard_index(client, index)
+        exit(1)
+
+
+def publish_index(client: Elasticsearch, index, restored):
+    try:
+        finish_bulk_index(client, index, restored)
+        swap_alias(client, 'pages_alias', index)
+    except Exception as err:
+        print('publish index ERROR:', err)
+        exit(1)
+
+
+def discard_index(client: Elasticsearch, index):
+    try:
+        delete_bulk_index(client, index)
+    except Exception as err:
+        print('delete index ERROR:', err)
+
+
+def assertData(conn, client: Elasticsearch, pages, index):
+    # returns whether the highlights of every page found in index match
     try:
         success = 0
         failure = 0
@@ -47,7 +137,7 @@ def assertData(conn, client: Elasticsearch, pages):
             countInPostgres = cursor.fetchone()['count']
             try:
                 countInElastic = len(client.get(
-                    index='pages_alias',
+                    index=index,
                     id=pageId,
                     _source=['highlights'])['_source']['highlights'])
             except NotFoundError as err:
@@ -66,88 +156,50 @@ def assertData(conn, client: Elasticsearch, pages):
         cursor.close()
         print(
             f'Asserted data, success: {success}, failure: {failure}, skip: {skip}')
+        return failure == 0
     except Exception as err:
         print('Assert data ERROR:', err)
-        exit(1)
+        return False
 
 
-def ingest_highlights(conn, pages):
+def ingest_highlights(conn, index):
+    # one streamed query for all pages and bulk update requests instead of
+    # a query and an update per page. returns whether every page was updated
     try:
-        import_count = 0
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        for page in pages:
-            pageId = page['pageId']
-            query = '''
-                SELECT
-                    id,
-                    quote,
-                    prefix,
-                    to_char(created_at, '{DATETIME_FORMAT}') as "createdAt",
-                    to_char(COALESCE(updated_at, current_timestamp), '{DATETIME_FORMAT}') as "updatedAt",
-                    suffix,
-                    patch,
-                    annotation,
-                    short_id as "shortId",
-                    user_id as "userId",
-                    to_char(shared_at, '{DATETIME_FORMAT}') as "sharedAt"
-                FROM omnivore.highlight
-                WHERE
-                    elastic_page_id = \'{pageId}\'
-                    AND deleted = false
-                    AND created_at > '{UPDATE_TIME}'
-            '''.format(pageId=pageId, DATETIME_FORMAT=DATETIME_FORMAT, UPDATE_TIME=UPDATE_TIME)
-
-            cursor.execute(query)
-            result = cursor.fetchall()
-            import_count += import_highlights_to_es(client, result, pageId)
-
-            print(f'Imported total {import_count} highlights to es')
-
-        cursor.close()
-    except Exception as err:
-        print('Export data to json ERROR:', err)
-
-
-def import_highlights_to_es(client, highlights, pageId) -> int:
-    # import highlights to elasticsearch
-    print(f'Writing {len(highlights)} highlights to page {pageId}')
-
-    if len(highlights) == 0:
-        print('No highlights to import')
-        return 0
-
-    try:
-        resp = client.update(
-            index='pages_alias',
-            id=pageId,
-            body={'doc': {'highlights': highlights}})
-
         count = 0
-        if resp['result'] == 'updated':
-            count = len(highlights)
-
-        print(f'Added {count} highlights to page {pageId}')
+        indexer = BulkIndexer(client)
+        cursor = conn.cursor(name='ingest_highlights', cursor_factory=RealDictCursor)
+        cursor.itersize = int(CURSOR_ITERSIZE)
+        cursor.execute(HIGHLIGHTS_BY_PAGE_QUERY)
+
+        for pages, pages_bytes in batch_rows(cursor, int(ES_BULK_SIZE), int(ES_BULK_BYTES)):
+            print(f'Writing highlights of {len(pages)} pages, {pages_bytes} bytes')
+            metrics.inc('pages_exported', len(pages))
+            indexer.submit([{
+                '_op_type': 'update',
+                '_index': index,
+                '_id': page['pageId'],
+                'doc': {'highlights': page['highlights']}
+            } for page in pages])
+            count += len(pages)
 
-        return count
+        cursor.close()
+        conn.commit()
+        # pages missing in the index are skipped like in assertData
+        updated_count, skipped_count, failed_count, error_count = indexer.close()
+        print(f'Updated highlights of {updated_count} of {count} pages in es, skipped {skipped_count}, '
+              f'failed {failed_count}, bulk errors {error_count}')
+        return failed_count == 0 and error_count == 0
     except Exception as err:
-        print('Elasticsearch update ERROR:', err)
-        return 0
+        print('Ingest highlights ERROR:', err)
+        conn.rollback()
+        return False
 
 
 def get_pages_with_highlights(conn):
     try:
-        query = f'''
-            SELECT DISTINCT
-                elastic_page_id as "pageId"
-            FROM omnivore.highlight
-            WHERE
-                elastic_page_id IS NOT NULL
-                AND deleted = false
-                AND created_at > '{UPDATE_TIME}'
-        '''
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query)
+        cursor.execute(PAGES_QUERY)
         result = cursor.fetchall()
         cursor.close()
         print('Found pages with highlights:', len(result))
@@ -156,11 +208,28 @@ def get_pages_with_highlights(conn):
         print('Get pages with highlights ERROR:', err)
 
 
+def profile_highlights(conn):
+    # plans only, nothing is written to elastic
+    try:
+        total = explain(conn, PAGES_QUERY)
+        print_plan('pages with highlights', total)
+        if not PROFILE:
+            return
+
+        sample = explain(
+            conn, f'SELECT * FROM ({HIGHLIGHTS_BY_PAGE_QUERY}) q LIMIT {int(PROFILE_SAMPLE_SIZE)}', analyze=True)
+        print_projection('highlights by page', sample, sample['rows'], total['rows'])
+    except Exception as err:
+        print('Profile highlights ERROR:', err)
+        exit(1)
+
+
 print('Starting migration')
+metrics.start('add_highlight_to_elastic')
 
 # test elastic client
 client = Elasticsearch(ES_URL, http_auth=(
-    ES_USERNAME, ES_PASSWORD), retry_on_timeout=True)
+    ES_USERNAME, ES_PASSWORD), retry_on_timeout=True, maxsize=int(ES_BULK_THREADS))
 try:
     print('Elasticsearch client connected', client.info())
 except Exception as err:
@@ -174,15 +243,34 @@ conn = psycopg2.connect(
 print('Postgres connection:', conn.info)
 
 
-update_mappings(client)
+if DRY_RUN:
+    profile_highlights(conn)
+else:
+    if REINDEX:
+        index, restored = reindex_with_mappings(client)
+    else:
+        update_mappings(client)
+        index = 'pages_alias'
+
+    pages = get_pages_with_highlights(conn)
+    if pages is not None:
+        metrics.track_progress('docs_indexed', len(pages))
 
-pages = get_pages_with_highlights(conn)
+    ingested = ingest_highlights(conn, index)
 
-ingest_highlights(conn, pages)
+    # the new index is checked before pages_alias moves to it, a failed
+    # load is deleted and the alias keeps pointing to the old index
+    asserted = assertData(conn, client, pages, index)
 
-assertData(conn, client, pages)
+    if REINDEX:
+        if not (ingested and asserted):
+            print('Load into', index, 'failed')
+            discard_index(client, index)
+            exit(1)
+        publish_index(client, index, restored)
 
 client.close()
 conn.close()
+metrics.stop()
 
 print('Migration complete')
@@ -0,0 +1,51 @@
+import asyncio
+
+
+def estimate_size(val):
+    # approximate payload size of a doc or row, strings dominate it
+    if isinstance(val, str):
+        return len(val)
+    if isinstance(val, dict):
+        return sum(estimate_size(v) for v in val.values())
+    if isinstance(val, (list, tuple)):
+        return sum(estimate_size(v) for v in val)
+    return 8
+
+
+def batch_rows(rows, max_rows, max_bytes):
+    # group rows in batches flushed at max_rows or max_bytes, whichever
+    # is reached first, yields (batch, batch_bytes)
+    batch = []
+    batch_bytes = 0
+    for row in rows:
+        batch.append(row)
+        batch_bytes += estimate_size(row)
+        if len(batch) >= max_rows or batch_bytes >= max_bytes:
+            yield batch, batch_bytes
+            batch = []
+            batch_bytes = 0
+    if len(batch) > 0:
+        yield batch, batch_bytes
+
+
+class ByteBudget:
+    """
+    Caps the bytes held by batches in flight, acquiring blocks the producer
+    until enough batches are released by the consumers.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            # a single batch over the limit still goes through on its own
+            await self.condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + size <= self.limit)
+            self.in_flight += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
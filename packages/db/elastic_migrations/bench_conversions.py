@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# Micro-benchmark of the per-document id and date conversions,
+# run with `python bench_conversions.py`
+import hashlib
+import os
+import timeit
+import uuid
+from datetime import datetime
+
+from conversions import convert_string_to_datetime, get_cached_uuid, get_uuid
+
+BENCH_ROUNDS = os.getenv('BENCH_ROUNDS', 20000)
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+USER_ID = 'a2b4a0e6-6b0c-11ee-8c99-0242ac120002'
+LABEL_IDS = ['a2b4a3e8-6b0c-11ee-8c99-0242ac120002', 'label-without-uuid']
+DOC = {
+    'id': 'c6a5f7b8-6b0c-11ee-8c99-0242ac120002',
+    'userId': USER_ID,
+    'createdAt': '2023-10-12T08:15:30.123Z',
+    'savedAt': '2023-10-12T08:15:30.123Z',
+    'updatedAt': '2023-10-13T09:00:00.000Z',
+    'publishedAt': '2023-10-01T00:00:00.000Z',
+    'readAt': None,
+    'archivedAt': None,
+    'labels': [{'id': label_id} for label_id in LABEL_IDS],
+    'highlights': [
+        {
+            'id': f'd{i}a5f7b8-6b0c-11ee-8c99-0242ac120002',
+            'userId': USER_ID,
+            'createdAt': '2023-10-12T08:20:00.456Z',
+            'updatedAt': '2023-10-12T08:20:00.456Z',
+        } for i in range(3)
+    ],
+}
+
+
+def legacy_get_uuid(val):
+    try:
+        return uuid.UUID(val)
+    except ValueError:
+        hex_string = hashlib.md5(val.encode('UTF-8')).hexdigest()
+        return uuid.UUID(hex=hex_string)
+
+
+def legacy_convert_string_to_datetime(val):
+    if val is None:
+        return None
+    try:
+        date = datetime.strptime(val, DATE_FORMAT)
+        if date.year <= 1:
+            return None
+        return date
+    except Exception:
+        return None
+
+
+def convert(doc, to_uuid, to_cached_uuid, to_datetime):
+    to_uuid(doc['id'])
+    to_cached_uuid(doc['userId'])
+    for field in ['createdAt', 'savedAt', 'updatedAt', 'publishedAt', 'readAt', 'archivedAt']:
+        to_datetime(doc[field])
+    for label in doc['labels']:
+        to_cached_uuid(label['id'])
+    for highlight in doc['highlights']:
+        to_uuid(highlight['id'])
+        to_cached_uuid(highlight['userId'])
+        to_datetime(highlight['createdAt'])
+        to_datetime(highlight['updatedAt'])
+
+
+def bench(name, fn):
+    rounds = int(BENCH_ROUNDS)
+    seconds = min(timeit.repeat(fn, number=rounds, repeat=5))
+    print(f'{name}: {seconds / rounds * 1e6:.2f} us per document')
+    return seconds
+
+
+# both implementations must agree before comparing their speed
+for val in [DOC['id'], LABEL_IDS[1]]:
+    assert get_uuid(val) == legacy_get_uuid(val)
+for val in [DOC['createdAt'], '2023-10-12T08:15:30.1Z', None]:
+    assert convert_string_to_datetime(val) == legacy_convert_string_to_datetime(val)
+
+before = bench('before', lambda: convert(DOC, legacy_get_uuid, legacy_get_uuid, legacy_convert_string_to_datetime))
+after = bench('after', lambda: convert(DOC, get_uuid, get_cached_uuid, convert_string_to_datetime))
+print(f'speedup: {before / after:.1f}x')
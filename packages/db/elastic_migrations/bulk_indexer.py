@@ -0,0 +1,123 @@
+import os
+import queue
+import threading
+
+from elasticsearch import helpers
+
+from migration_utils.metrics import metrics
+
+# threads sending bulk requests concurrently, the client needs a connection
+# pool at least as large (maxsize) so they don't queue for a connection
+ES_BULK_THREADS = os.getenv('ES_BULK_THREADS', 4)
+# batches of actions buffered ahead of the threads before submit blocks
+ES_BULK_QUEUE_SIZE = os.getenv('ES_BULK_QUEUE_SIZE', 8)
+# a bulk request is sent at ES_BULK_SIZE actions or ES_BULK_BYTES, whichever comes first
+ES_BULK_SIZE = os.getenv('ES_BULK_SIZE', 500)
+ES_BULK_BYTES = os.getenv('ES_BULK_BYTES', 10 * 1024 * 1024)
+# only items rejected with 429 are retried, with exponential backoff
+ES_BULK_MAX_RETRIES = os.getenv('ES_BULK_MAX_RETRIES', 5)
+ES_BULK_INITIAL_BACKOFF = os.getenv('ES_BULK_INITIAL_BACKOFF', 2)
+ES_BULK_MAX_BACKOFF = os.getenv('ES_BULK_MAX_BACKOFF', 60)
+ES_BULK_TIMEOUT = os.getenv('ES_BULK_TIMEOUT', 60)
+
+
+def item_error(item):
+    # bulk items are keyed by their op type, e.g. {'index': {'_id': ..., 'error': ...}}
+    info = next(iter(item.values()))
+    return info.get('_id'), info.get('error', info.get('status'))
+
+
+def is_missing_document(item):
+    # an update of a doc that doesn't exist, e.g. highlights of a page the
+    # index doesn't have
+    info = item.get('update')
+    return (info is not None and info.get('status') == 404
+            and (info.get('error') or {}).get('type') == 'document_missing_exception')
+
+
+class BulkIndexer:
+    """
+    Sends bulk actions to elastic from a pool of threads fed by a bounded
+    queue, so the producer keeps reading while requests are in flight and
+    blocks once the threads fall behind.
+
+    Each thread runs streaming_bulk, which chunks the actions by count and
+    bytes and retries items rejected with 429 with exponential backoff.
+    Updates of missing docs are counted as skipped, other item errors are
+    reported and counted as failed. A request that
+    fails as a whole drops the actions streaming_bulk had taken off the
+    queue, it is counted as an error since their number is unknown.
+    """
+
+    def __init__(self, client, chunk_size=None, max_chunk_bytes=None, threads=None):
+        self.client = client
+        self.chunk_size = int(ES_BULK_SIZE if chunk_size is None else chunk_size)
+        self.max_chunk_bytes = int(ES_BULK_BYTES if max_chunk_bytes is None else max_chunk_bytes)
+        self.queue = queue.Queue(maxsize=int(ES_BULK_QUEUE_SIZE))
+        self.lock = threading.Lock()
+        self.indexed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = 0
+        self.threads = [threading.Thread(target=self.work, daemon=True)
+                        for _ in range(int(ES_BULK_THREADS if threads is None else threads))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, actions):
+        self.queue.put(actions)
+
+    def close(self):
+        # one end marker per thread, returns (indexed, skipped, failed, errors),
+        # the load is only complete without failed docs and errors
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.indexed, self.skipped, self.failed, self.errors
+
+    def actions(self, state):
+        while True:
+            actions = self.queue.get()
+            if actions is None:
+                state['done'] = True
+                return
+            yield from actions
+
+    def work(self):
+        state = {'done': False}
+        # a failed request ends streaming_bulk, start over with the next
+        # actions until the end marker so submit never blocks forever
+        while not state['done']:
+            try:
+                for ok, item in helpers.streaming_bulk(
+                        self.client, self.actions(state),
+                        chunk_size=self.chunk_size,
+                        max_chunk_bytes=self.max_chunk_bytes,
+                        max_retries=int(ES_BULK_MAX_RETRIES),
+                        initial_backoff=float(ES_BULK_INITIAL_BACKOFF),
+                        max_backoff=float(ES_BULK_MAX_BACKOFF),
+                        raise_on_error=False,
+                        raise_on_exception=False,
+                        request_timeout=int(ES_BULK_TIMEOUT)):
+                    skipped = not ok and is_missing_document(item)
+                    if skipped:
+                        print('Elasticsearch bulk item skipped, missing doc:', item_error(item)[0])
+                        metrics.inc('docs_missing')
+                    elif not ok:
+                        print('Elasticsearch bulk item ERROR:', *item_error(item))
+                        metrics.inc('docs_failed')
+                    else:
+                        metrics.inc('docs_indexed')
+                    with self.lock:
+                        if ok:
+                            self.indexed += 1
+                        elif skipped:
+                            self.skipped += 1
+                        else:
+                            self.failed += 1
+            except Exception as err:
+                print('Elasticsearch bulk ERROR:', err)
+                metrics.inc('bulk_errors')
+                with self.lock:
+                    self.errors += 1
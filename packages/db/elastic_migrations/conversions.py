@@ -0,0 +1,59 @@
+import hashlib
+import os
+import re
+import uuid
+from datetime import datetime
+from functools import lru_cache
+
+UUID_CACHE_SIZE = os.getenv('UUID_CACHE_SIZE', 65536)
+
+# ISO 8601 format
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# canonical form of a uuid, anything else goes through the slow path
+UUID_PATTERN = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+
+def get_uuid(val):
+    if UUID_PATTERN.fullmatch(val):
+        return uuid.UUID(val)
+    try:
+        # other spellings uuid.UUID accepts, e.g. without hyphens
+        return uuid.UUID(val)
+    except ValueError:
+        id = convert_string_to_uuid(val)
+        return id
+
+
+# ids repeating across docs (users, labels, groups) are worth caching,
+# the ids of the docs themselves are unique and would only evict them
+get_cached_uuid = lru_cache(maxsize=int(UUID_CACHE_SIZE))(get_uuid)
+
+
+def convert_string_to_uuid(val):
+    hex_string = hashlib.md5(val.encode('UTF-8')).hexdigest()
+    return uuid.UUID(hex=hex_string)
+
+
+def parse_datetime(val):
+    # elastic stores dates as e.g. 2023-01-02T03:04:05.678Z, parse that
+    # shape with the C implemented fromisoformat instead of strptime
+    if len(val) == 24 and val[23] == 'Z' and val[10] == 'T' and val[19] == '.':
+        try:
+            return datetime.fromisoformat(val[:23])
+        except ValueError:
+            pass
+    return datetime.strptime(val, DATE_FORMAT)
+
+
+def convert_string_to_datetime(val):
+    if val is None:
+        return None
+    try:
+        date = parse_datetime(val)
+        if date.year <= 1:
+            # avoid year 0 is out of range error
+            return None
+        return date
+    except Exception as err:
+        print('Convert string to datetime ERROR:', err)
+        return None
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import uuid
+
+# hex digits of the id per tree level, 3 levels give 4096 leaf ranges
+DIGEST_TREE_DEPTH = os.getenv('DIGEST_TREE_DEPTH', 3)
+
+HEX_DIGITS = '0123456789abcdef'
+MODULUS = 1 << 128
+
+
+def row_digest(id, updated_at, content_md5):
+    digest = hashlib.md5(f'{id}:{updated_at}:{content_md5}'.encode('utf-8')).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def id_key(id):
+    return str(id).replace('-', '').lower()
+
+
+def prefix_range(prefix):
+    # lowest and highest uuid starting with the hex prefix
+    low = uuid.UUID(prefix.ljust(32, '0'))
+    high = uuid.UUID(prefix.ljust(32, 'f'))
+    return low, high
+
+
+class DigestTree:
+    """
+    Merkle style tree over rows keyed by id, nodes are the hex prefixes of
+    the ids. A node's digest is the sum of the digests of its rows, so rows
+    can be added in any order and equal nodes prove equal ranges.
+    """
+
+    def __init__(self, depth=None):
+        self.depth = int(DIGEST_TREE_DEPTH) if depth is None else depth
+        self.nodes = {}
+
+    def add(self, id, updated_at, content_md5):
+        digest = row_digest(id, updated_at, content_md5)
+        key = id_key(id)
+        for level in range(self.depth + 1):
+            node = self.nodes.setdefault(key[:level], [0, 0])
+            node[0] += 1
+            node[1] = (node[1] + digest) % MODULUS
+
+    def count(self, prefix=''):
+        return self.nodes.get(prefix, [0, 0])[0]
+
+    def node(self, prefix):
+        return tuple(self.nodes.get(prefix, (0, 0)))
+
+
+def diff_trees(a, b, prefix=''):
+    # only descend into nodes whose digests differ, returns the leaf prefixes
+    if a.node(prefix) == b.node(prefix):
+        return []
+    if len(prefix) == a.depth:
+        return [prefix]
+    leaves = []
+    for digit in HEX_DIGITS:
+        leaves += diff_trees(a, b, prefix + digit)
+    return leaves
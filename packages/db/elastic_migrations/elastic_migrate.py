@@ -1,10 +1,26 @@
 #!/usr/bin/python
-from datetime import datetime
 import os
+import sys
 import json
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch
+
+# the helpers in packages/db/migration_utils are shared with the other
+# scripts of packages/db
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migration_utils.metrics import metrics
+from migration_utils.profiling import DRY_RUN, PROFILE, PROFILE_SAMPLE_SIZE, explain, print_plan, print_projection
+
+from batching import batch_rows
+from bulk_indexer import ES_BULK_THREADS, BulkIndexer
+from export_sink import ExportSink
+from conversions import parse_datetime
+from index_lifecycle import (create_bulk_index, delete_bulk_index, finish_bulk_index, live_index_settings, swap_alias,
+                             versioned_index_name)
+from reconcile import composite_page, composite_query, diff_counts
+from snapshot import SnapshotWriter, load_manifest, read_snapshot
 
 PG_HOST = os.getenv('PG_HOST', 'localhost')
 PG_PORT = os.getenv('PG_PORT', 5432)
@@ -14,10 +30,24 @@ PG_DB = os.getenv('PG_DB', 'omnivore')
 ES_URL = os.getenv('ES_URL', 'http://localhost:9200')
 ES_USERNAME = os.getenv('ES_USERNAME', 'elastic')
 ES_PASSWORD = os.getenv('ES_PASSWORD', 'password')
-DATA_FILE = os.getenv('DATA_FILE', 'data.json')
+# optional NDJSON dump of the exported rows, disabled when empty
+DATA_FILE = os.getenv('DATA_FILE', '')
 BULK_SIZE = os.getenv('BULK_SIZE', 100)
-UPDATE_TIME = os.getenv('UPDATE_TIME', '2019-01-01 00:00:00')
+# a bulk request is flushed at BULK_SIZE docs or BULK_BYTES, whichever comes first
+BULK_BYTES = os.getenv('BULK_BYTES', 10 * 1024 * 1024)
+# rows fetched per round trip of the server side export cursor
+CURSOR_ITERSIZE = os.getenv('CURSOR_ITERSIZE', 500)
+# migrate, or replay to index a snapshot without postgres
+MODE = os.getenv('MODE', 'migrate')
+# snapshot directory written while migrating and read by replay, disabled when empty
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', '')
+# the default UPDATE_TIME is older than every page, a new index is only
+# built from a load of all of them
+FULL_UPDATE_TIME = '2019-01-01 00:00:00'
+UPDATE_TIME = os.getenv('UPDATE_TIME', FULL_UPDATE_TIME)
 INDEX_SETTINGS = os.getenv('INDEX_SETTINGS', 'index_settings.json')
+# load into a new index and swap pages_alias over even if it already exists
+REINDEX = os.getenv('REINDEX', 'false') == 'true' or '--reindex' in sys.argv
 
 DATETIME_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"'
 QUERY = f'''
@@ -75,54 +105,124 @@ UPDATE_HIGHLIGHT_SQL = f'''
 '''
 
 
+def sample_query(query, alias, table, limit):
+    # restrict an update to a few rows so it can be analyzed
+    return f'''{query}
+        AND {alias}.id IN (
+            SELECT id FROM omnivore.{table} WHERE updated_at > '{UPDATE_TIME}' LIMIT {limit})
+    '''
+
+
+def profile_migration(conn):
+    # plans only, nothing is indexed or updated
+    try:
+        updates = [
+            ('article_saving_request', 'a', UPDATE_ARTICLE_SAVING_REQUEST_SQL),
+            ('highlight', 'h', UPDATE_HIGHLIGHT_SQL),
+        ]
+        total = explain(conn, QUERY)
+        print_plan('pages to index', total)
+        for table, alias, query in updates:
+            print_plan(f'{table} updates', explain(conn, query))
+
+        if not PROFILE:
+            return
+        sample = explain(
+            conn, f'SELECT * FROM ({QUERY}) q LIMIT {int(BULK_SIZE)}', analyze=True)
+        print_projection('pages to index', sample, sample['rows'], total['rows'])
+        for table, alias, query in updates:
+            update_total = explain(conn, query)
+            sample = explain(
+                conn, sample_query(query, alias, table, int(PROFILE_SAMPLE_SIZE)), analyze=True)
+            print_projection(f'{table} updates', sample, sample['rows'], update_total['rows'])
+    except Exception as err:
+        print('Profile migration ERROR:', err)
+        exit(1)
+
+
 def assertData(conn, client):
-    # get all users from postgres
+    # reconcile all users in one pass: one GROUP BY query in postgres and a
+    # paginated composite aggregation in elastic, diffed in memory
     try:
-        success = 0
-        failure = 0
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         cursor.execute('''SELECT id FROM omnivore.user''')
-        result = cursor.fetchall()
-        for row in result:
-            userId = row['id']
-            cursor.execute(
-                f'SELECT COUNT(*) FROM omnivore.links WHERE user_id = \'{userId}\'''')
-            countInPostgres = cursor.fetchone()['count']
-            countInElastic = client.count(
-                index='pages_alias', body={'query': {'term': {'userId': userId}}})['count']
-
-            if countInPostgres == countInElastic:
-                success += 1
-                print(f'User {userId} OK')
-            else:
-                failure += 1
-                print(
-                    f'User {userId} ERROR: postgres: {countInPostgres}, elastic: {countInElastic}')
+        userIds = [row['id'] for row in cursor.fetchall()]
+        cursor.execute(
+            '''SELECT user_id, COUNT(*) FROM omnivore.links GROUP BY user_id''')
+        countsInPostgres = {
+            str(row['user_id']): row['count'] for row in cursor.fetchall()}
         cursor.close()
-        print(f'Asserted data, success: {success}, failure: {failure}')
+
+        countsInElastic = {}
+        afterKey = None
+        while True:
+            result = client.search(
+                index='pages_alias',
+                body=composite_query({'match_all': {}}, 'userId', afterKey))
+            buckets, afterKey = composite_page(result)
+            for bucket in buckets:
+                countsInElastic[bucket['key']['userId']] = bucket['doc_count']
+            if afterKey is None:
+                break
+
+        diff_counts(userIds, countsInPostgres, countsInElastic)
     except Exception as err:
         print('Assert data ERROR:', err)
         exit(1)
 
 
-def create_index(client):
+def create_index(client, update_time):
+    # returns the index to load and the settings to restore after the load,
+    # None when loading into the live index
     print('Creating index')
     try:
         # check if index exists
-        if client.indices.exists(index='pages_alias'):
+        if client.indices.exists(index='pages_alias') and not REINDEX:
             print('Index already exists')
-            return
+            return 'pages_alias', None
 
-        # create index
+        # a new versioned index is loaded without refreshes and replicas,
+        # pages_alias only moves over to it once it is complete
+        if update_time != FULL_UPDATE_TIME:
+            raise Exception(f'a new index would only hold the pages updated after {update_time}, '
+                            'unset UPDATE_TIME to build it')
         with open(INDEX_SETTINGS, 'r') as f:
             settings = json.load(f)
-            client.indices.create(index='pages', body=settings)
+        restored = live_index_settings(client, 'pages_alias', settings)
+        index = versioned_index_name('pages')
+        create_bulk_index(client, index, settings)
         print('Index created')
+        return index, restored
     except Exception as err:
         print('Create index ERROR:', err)
         exit(1)
 
 
+def publish_index(client, index, restored):
+    try:
+        finish_bulk_index(client, index, restored)
+        swap_alias(client, 'pages_alias', index)
+    except Exception as err:
+        print('Publish index ERROR:', err)
+        exit(1)
+
+
+def finish_load(client, index, restored, loaded):
+    # pages_alias only moves to a new index loaded without any error, a
+    # failed one is deleted and the alias keeps pointing to the old index
+    if loaded:
+        if restored is not None:
+            publish_index(client, index, restored)
+        return
+    print('Load into', index, 'failed')
+    if restored is not None:
+        try:
+            delete_bulk_index(client, index)
+        except Exception as err:
+            print('Delete index ERROR:', err)
+    exit(1)
+
+
 def update_postgres_data(conn, query, table):
     try:
         print('Executing query: {}'.format(query))
@@ -137,75 +237,99 @@ def update_postgres_data(conn, query, table):
         print('Update postgres data ERROR:', err)
 
 
-def elastic_bulk_insert(client, doc_list) -> int:
-    print('Bulk docs length:', len(doc_list))
-    try:
-        # use the helpers library's Bulk API to index list of
-        # Elasticsearch docs
-        resp = helpers.bulk(
-            client,
-            doc_list,
-            request_timeout=30,
-        )
-        # print the response returned by Elasticsearch
-        print('helpers.bulk() RESPONSE:',
-              json.dumps(resp, indent=2))
-        return resp[0]
-    except Exception as err:
-        print('Elasticsearch helpers.bulk() ERROR:', err)
-        return 0
-
-
-def ingest_data_to_elastic(conn, query, data_file):
+def ingest_data_to_elastic(conn, query, data_file, index):
+    # returns whether every row was exported and indexed
     try:
         print('Executing query: {}'.format(query))
-        # export data from postgres
+        # export data from postgres, the indexer sends the bulk requests on
+        # its own threads while the next rows are read
         count = 0
-        import_count = 0
-        with open(data_file, 'w') as f:
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            cursor.execute(query)
-
-            result = cursor.fetchmany(BULK_SIZE)
-            while len(result) > 0:
-                print(f'Writing {len(result)} docs to file')
-                import_count += import_data_to_es(client, result)
-                count += len(result)
-                f.write(json.dumps(result, indent=2, default=str))
-                result = cursor.fetchmany(BULK_SIZE)
-
-            cursor.close()
-        print(f'Exported {count} rows to data.json')
-        print(f'Imported {import_count} rows to es')
-
-    except Exception as err:
-        print('Export data to json ERROR:', err)
+        indexer = BulkIndexer(client, int(BULK_SIZE), int(BULK_BYTES))
+        # the dump is written on its own thread, off the indexing path
+        sink = ExportSink(data_file) if data_file else None
+        snapshot = SnapshotWriter(SNAPSHOT_DIR, {'source': 'postgres', 'update_time': UPDATE_TIME}) \
+            if SNAPSHOT_DIR else None
+        # a named cursor lives on the server and is read CURSOR_ITERSIZE
+        # rows at a time, a client side cursor would load the whole
+        # result with all the page content into memory first
+        # the planner's row estimate is enough for an ETA
+        metrics.track_progress('docs_indexed', explain(conn, query)['rows'])
+        cursor = conn.cursor(name='ingest_data_to_elastic', cursor_factory=RealDictCursor)
+        cursor.itersize = int(CURSOR_ITERSIZE)
+        cursor.execute(query)
 
+        for result, result_bytes in batch_rows(cursor, int(BULK_SIZE), int(BULK_BYTES)):
+            print(f'Indexing {len(result)} docs, {result_bytes} bytes')
+            metrics.inc('rows_exported', len(result))
+            metrics.inc('bytes_exported', result_bytes)
+            actions = bulk_actions(result, index)
+            indexer.submit(actions)
+            if sink is not None:
+                sink.write(result)
+            if snapshot is not None:
+                snapshot.write(actions)
+            count += len(result)
 
-def import_data_to_es(client, docs) -> int:
-    # import data to elasticsearch
-    print('Importing docs to elasticsearch:', len(docs))
+        cursor.close()
+        import_count, _, failed_count, error_count = indexer.close()
+        print(f'Exported {count} rows from postgres')
+        print(f'Imported {import_count} rows to es, failed {failed_count}, bulk errors {error_count}')
+        if sink is not None:
+            print(f'Exported {sink.close()} rows to {data_file}')
+        if snapshot is not None:
+            snapshot.close()
+        return failed_count == 0 and error_count == 0
 
-    if len(docs) == 0:
-        print('No data to import')
-        return 0
+    except Exception as err:
+        print('Export data to json ERROR:', err)
+        # end the cursor's transaction so the updates below can run
+        conn.rollback()
+        return False
 
-    print('Attempting to index the list of docs using helpers.bulk()')
 
-    doc_list = []
+def bulk_actions(docs, index):
+    actions = []
     for doc in docs:
         doc['publishedAt'] = validated_date(doc['publishedAt'])
-        # convert the string to a dict object
-        dict_doc = {
-            '_index': 'pages_alias',
+        actions.append({
+            '_index': index,
             '_id': doc['id'],
             '_source': doc
-        }
-        doc_list += [dict_doc]
+        })
+    return actions
 
-    count = elastic_bulk_insert(client, doc_list)
-    print(f'Imported {count} docs to elasticsearch')
-    return count
+
+def snapshot_update_time(snapshot_dir):
+    try:
+        return load_manifest(snapshot_dir)['params'].get('update_time', FULL_UPDATE_TIME)
+    except Exception as err:
+        print('Load snapshot ERROR:', err)
+        exit(1)
+
+
+def replay_snapshot(snapshot_dir, index):
+    # index the docs of a snapshot, postgres is not needed. returns whether
+    # every doc was indexed
+    try:
+        manifest = load_manifest(snapshot_dir)
+        print(f'Replaying {manifest["docs"]} docs from {snapshot_dir}')
+        metrics.track_progress('docs_indexed', manifest['docs'])
+        indexer = BulkIndexer(client, int(BULK_SIZE), int(BULK_BYTES))
+        for docs, docs_bytes in batch_rows(read_snapshot(snapshot_dir), int(BULK_SIZE), int(BULK_BYTES)):
+            print(f'Indexing {len(docs)} docs, {docs_bytes} bytes')
+            metrics.inc('docs_replayed', len(docs))
+            indexer.submit([{
+                '_index': index,
+                '_id': doc['_id'],
+                '_source': doc['_source']
+            } for doc in docs])
+        import_count, _, failed_count, error_count = indexer.close()
+        print(f'Replayed {import_count} of {manifest["docs"]} docs to es, failed {failed_count}, '
+              f'bulk errors {error_count}')
+        return failed_count == 0 and error_count == 0 and import_count == manifest['docs']
+    except Exception as err:
+        print('Replay snapshot ERROR:', err)
+        return False
 
 
 def validated_date(date):
@@ -213,7 +337,7 @@ def validated_date(date):
         if date is None:
             return None
 
-        datetime_object = datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%fZ')
+        datetime_object = parse_datetime(date)
         # Make sure the date year is not greater than 9999
         if datetime_object.year > 9999:
             return None
@@ -225,35 +349,52 @@ def validated_date(date):
 
 
 print('Starting migration')
+metrics.start('elastic_migrate')
 
 # test elastic client
 client = Elasticsearch(ES_URL, http_auth=(
-    ES_USERNAME, ES_PASSWORD), retry_on_timeout=True)
+    ES_USERNAME, ES_PASSWORD), retry_on_timeout=True, maxsize=int(ES_BULK_THREADS))
 try:
     print('Elasticsearch client connected', client.info())
 except Exception as err:
     print('Elasticsearch client ERROR:', err)
     exit(1)
 
-# test postgres client
-conn = psycopg2.connect(
-    f'host={PG_HOST} port={PG_PORT} dbname={PG_DB} user={PG_USER} \
-    password={PG_PASSWORD}')
-print('Postgres connection:', conn.info)
+conn = None
+if MODE != 'replay':
+    # test postgres client
+    conn = psycopg2.connect(
+        f'host={PG_HOST} port={PG_PORT} dbname={PG_DB} user={PG_USER} \
+        password={PG_PASSWORD}')
+    print('Postgres connection:', conn.info)
+
+if MODE == 'replay':
+    index, restored = create_index(client, snapshot_update_time(SNAPSHOT_DIR))
+
+    # rebuild the index from the snapshot alone
+    loaded = replay_snapshot(SNAPSHOT_DIR, index)
+
+    finish_load(client, index, restored, loaded)
+elif DRY_RUN:
+    profile_migration(conn)
+else:
+    index, restored = create_index(client, UPDATE_TIME)
 
-create_index(client)
+    # ingest data from postgres to es and optionally a NDJSON file
+    loaded = ingest_data_to_elastic(conn, QUERY, DATA_FILE, index)
 
-# ingest data from postgres to es and json file (for debugging)
-ingest_data_to_elastic(conn, QUERY, DATA_FILE)
+    finish_load(client, index, restored, loaded)
 
-# update existing tables
-update_postgres_data(conn, UPDATE_ARTICLE_SAVING_REQUEST_SQL,
-                     'article_saving_request')
-update_postgres_data(conn, UPDATE_HIGHLIGHT_SQL, 'highlight')
+    # update existing tables
+    update_postgres_data(conn, UPDATE_ARTICLE_SAVING_REQUEST_SQL,
+                         'article_saving_request')
+    update_postgres_data(conn, UPDATE_HIGHLIGHT_SQL, 'highlight')
 
-assertData(conn, client)
+    assertData(conn, client)
 
 client.close()
-conn.close()
+if conn is not None:
+    conn.close()
+metrics.stop()
 
 print('Migration complete')
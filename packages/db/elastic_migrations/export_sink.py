@@ -0,0 +1,88 @@
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+
+# none, gzip or zstd, zstd needs the zstandard package
+EXPORT_COMPRESSION = os.getenv('EXPORT_COMPRESSION', 'none')
+# batches buffered ahead of the writer thread before write blocks
+EXPORT_QUEUE_SIZE = os.getenv('EXPORT_QUEUE_SIZE', 16)
+
+
+def open_export(path, compression):
+    if compression == 'gzip':
+        # a low level keeps the writer ahead of the migration
+        return gzip.open(path, 'wt', encoding='utf-8', compresslevel=1)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('EXPORT_COMPRESSION=zstd needs the zstandard package')
+        writer = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(writer, encoding='utf-8')
+    if compression == 'none':
+        return open(path, 'w', encoding='utf-8')
+    raise Exception(f'Unknown export compression {compression}')
+
+
+def open_import(path):
+    # reads what open_export wrote, the compression is told by the magic bytes
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if magic == b'\x28\xb5\x2f\xfd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(f'{path} is zstd compressed, reading it needs the zstandard package')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+class ExportSink:
+    """
+    Writes batches of rows as compact NDJSON, one row per line, on a
+    background thread so serializing and compressing the dump doesn't
+    slow down the migration. The bounded queue caps the memory held by
+    batches not written yet.
+    """
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.file = open_export(path, EXPORT_COMPRESSION if compression is None else compression)
+        self.queue = queue.Queue(maxsize=int(EXPORT_QUEUE_SIZE))
+        self.count = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def write(self, rows):
+        self.queue.put(rows)
+
+    def close(self):
+        # waits for the queued batches, returns the number of rows written
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            print(f'Export to {self.path} ERROR:', self.error)
+        return self.count
+
+    def work(self):
+        while True:
+            rows = self.queue.get()
+            if rows is None:
+                return
+            # keep draining after an error so write never blocks
+            if self.error is not None:
+                continue
+            try:
+                self.file.write(''.join(json.dumps(row, default=str, separators=(',', ':')) + '\n'
+                                        for row in rows))
+                self.count += len(rows)
+            except Exception as err:
+                self.error = err
@@ -0,0 +1,87 @@
+import copy
+import os
+import time
+
+# settings restored after the load when there is no live index to copy them
+# from, no replicas so a single node cluster reaches green
+ES_REFRESH_INTERVAL = os.getenv('ES_REFRESH_INTERVAL', '1s')
+ES_REPLICAS = os.getenv('ES_REPLICAS', 0)
+# segments per shard left by the force merge after the load
+ES_MAX_NUM_SEGMENTS = os.getenv('ES_MAX_NUM_SEGMENTS', 1)
+# seconds to wait for the force merge, reindex and replica recovery
+ES_LIFECYCLE_TIMEOUT = os.getenv('ES_LIFECYCLE_TIMEOUT', 3600)
+
+
+def versioned_index_name(prefix):
+    return f'{prefix}_{time.strftime("%Y%m%d%H%M%S", time.gmtime())}'
+
+
+def live_index_settings(client, alias, settings):
+    # refresh interval and replicas to restore, taken from the index behind
+    # the alias, then the settings file, then the defaults
+    index_settings = settings.get('settings', {}).get('index', {})
+    restored = {
+        'refresh_interval': index_settings.get('refresh_interval', ES_REFRESH_INTERVAL),
+        'number_of_replicas': int(index_settings.get('number_of_replicas', ES_REPLICAS)),
+    }
+    if client.indices.exists_alias(name=alias):
+        live = next(iter(client.indices.get_settings(index=alias).values()))['settings']['index']
+        restored['refresh_interval'] = live.get('refresh_interval', restored['refresh_interval'])
+        restored['number_of_replicas'] = int(live.get('number_of_replicas', restored['number_of_replicas']))
+    return restored
+
+
+def create_bulk_index(client, name, settings):
+    # a new index without the alias, not refreshed and not replicated while loading
+    body = copy.deepcopy(settings)
+    body.pop('aliases', None)
+    body.setdefault('settings', {}).setdefault('index', {}).update({
+        'refresh_interval': '-1',
+        'number_of_replicas': 0,
+    })
+    print('Creating index', name)
+    client.indices.create(index=name, body=body)
+
+
+def reindex_from_alias(client, alias, name):
+    # copy the docs of the live index into the new one, sliced per shard
+    print('Reindexing', alias, 'into', name)
+    resp = client.reindex(
+        body={'source': {'index': alias}, 'dest': {'index': name}},
+        slices='auto', wait_for_completion=True,
+        request_timeout=int(ES_LIFECYCLE_TIMEOUT))
+    print(f'Reindexed {resp["total"]} docs in {resp["took"]}ms, failures: {len(resp["failures"])}')
+    if len(resp['failures']) > 0 or resp.get('timed_out'):
+        raise Exception(f'Reindex of {alias} into {name} is incomplete: {resp["failures"][:5]}')
+    return resp
+
+
+def finish_bulk_index(client, name, restored):
+    print('Force merging', name)
+    client.indices.refresh(index=name)
+    client.indices.forcemerge(index=name, max_num_segments=int(ES_MAX_NUM_SEGMENTS),
+                              request_timeout=int(ES_LIFECYCLE_TIMEOUT))
+    print('Restoring settings of', name, restored)
+    client.indices.put_settings(index=name, body={'index': restored})
+    # only serve from the index once its replicas are allocated
+    client.cluster.health(index=name, wait_for_status='green' if restored['number_of_replicas'] > 0 else 'yellow',
+                          timeout=f'{int(ES_LIFECYCLE_TIMEOUT)}s', request_timeout=int(ES_LIFECYCLE_TIMEOUT))
+
+
+def delete_bulk_index(client, name):
+    # drops a new index whose load failed, the alias never pointed to it
+    print('Deleting index', name)
+    client.indices.delete(index=name, ignore_unavailable=True)
+
+
+def swap_alias(client, alias, name):
+    # move the alias to the new index in one atomic request, returns the old
+    # indices which are kept so the swap can be rolled back by hand
+    old = []
+    if client.indices.exists_alias(name=alias):
+        old = [index for index in client.indices.get_alias(name=alias) if index != name]
+    actions = [{'remove': {'index': index, 'alias': alias}} for index in old]
+    actions.append({'add': {'index': name, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    print(f'Alias {alias} now points to {name}, previous indices: {old}')
+    return old
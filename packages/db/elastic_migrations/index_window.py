@@ -0,0 +1,113 @@
+import asyncio
+import os
+import time
+
+from migration_utils.checkpoint import load_checkpoint, save_checkpoint
+from migration_utils.metrics import metrics
+
+# the definitions of the dropped indexes, kept until every one is rebuilt so
+# an interrupted run restores them on its next start
+INDEX_STATE_FILE = os.getenv('INDEX_STATE_FILE', 'migrate_from_elastic.indexes.json')
+# tables whose indexes are built at the same time, and the memory and
+# parallel workers each build may use. CREATE INDEX CONCURRENTLY locks out
+# other builds on its table, so the indexes of a table are built one at a
+# time and max_parallel_maintenance_workers speeds up each of them
+INDEX_BUILD_WORKERS = os.getenv('INDEX_BUILD_WORKERS', 2)
+INDEX_MAINTENANCE_WORK_MEM = os.getenv('INDEX_MAINTENANCE_WORK_MEM', '1GB')
+INDEX_PARALLEL_WORKERS = os.getenv('INDEX_PARALLEL_WORKERS', 2)
+
+# unique and primary key indexes stay, the upserts need their conflict
+# targets, and so do indexes backing a constraint
+SECONDARY_INDEXES_QUERY = '''
+    SELECT n.nspname AS schema, ic.relname AS name, c.relname AS table, pg_get_indexdef(i.indexrelid) AS definition
+    FROM pg_index i
+    INNER JOIN pg_class ic ON ic.oid = i.indexrelid
+    INNER JOIN pg_class c ON c.oid = i.indrelid
+    INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'omnivore' AND c.relname = ANY($1::text[])
+        AND NOT i.indisunique AND NOT i.indisprimary
+        AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid)
+    ORDER BY c.relname, ic.relname
+'''
+
+INDEX_VALID_QUERY = '''
+    SELECT i.indisvalid
+    FROM pg_index i
+    INNER JOIN pg_class ic ON ic.oid = i.indexrelid
+    INNER JOIN pg_namespace n ON n.oid = ic.relnamespace
+    WHERE n.nspname = $1 AND ic.relname = $2
+'''
+
+
+def concurrent_definition(definition):
+    return definition.replace('CREATE INDEX ', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ', 1)
+
+
+async def drop_indexes(pool, tables):
+    # opens the bulk window, an unfinished window of an earlier run is
+    # continued with the definitions it recorded
+    state = load_checkpoint(INDEX_STATE_FILE)
+    if state is None:
+        rows = await pool.fetch(SECONDARY_INDEXES_QUERY, tables)
+        state = {'indexes': [dict(row) for row in rows]}
+        # record before dropping anything
+        save_checkpoint(INDEX_STATE_FILE, state)
+    else:
+        print('Continuing the bulk window recorded in', INDEX_STATE_FILE)
+
+    for index in state['indexes']:
+        print('Dropping index', index['name'], 'on', index['table'])
+        await pool.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index["schema"]}"."{index["name"]}"', timeout=None)
+    print(f'Dropped {len(state["indexes"])} indexes, definitions in {INDEX_STATE_FILE}')
+
+
+async def build_index(pool, index):
+    async with pool.acquire() as db_conn:
+        valid = await db_conn.fetchval(INDEX_VALID_QUERY, index['schema'], index['name'])
+        if valid:
+            return
+        if valid is not None:
+            # an interrupted concurrent build leaves an invalid index behind
+            print('Dropping invalid index', index['name'])
+            await db_conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index["schema"]}"."{index["name"]}"',
+                                  timeout=None)
+        print('Building index', index['name'], 'on', index['table'])
+        started_at = time.time()
+        await db_conn.execute(f"SET maintenance_work_mem = '{INDEX_MAINTENANCE_WORK_MEM}'")
+        await db_conn.execute(f'SET max_parallel_maintenance_workers = {int(INDEX_PARALLEL_WORKERS)}')
+        await db_conn.execute(concurrent_definition(index['definition']), timeout=None)
+        print(f'Built index {index["name"]} in {time.time() - started_at:.1f}s')
+        metrics.observe('index_build', time.time() - started_at, table=index['table'])
+
+
+async def restore_indexes(pool, tables=None):
+    # rebuilds the recorded indexes of tables, all when None, and closes the
+    # window once every index is back. safe to run again after a failure
+    state = load_checkpoint(INDEX_STATE_FILE)
+    if state is None:
+        return
+    by_table = {}
+    for index in state['indexes']:
+        if tables is None or index['table'] in tables:
+            by_table.setdefault(index['table'], []).append(index)
+    table_indexes = asyncio.Queue()
+    for indexes in by_table.values():
+        table_indexes.put_nowait(indexes)
+    failed = []
+
+    async def worker():
+        # one table at a time, its indexes one after the other
+        while not table_indexes.empty():
+            for index in table_indexes.get_nowait():
+                try:
+                    await build_index(pool, index)
+                except Exception as err:
+                    print('Build index ERROR:', index['name'], err)
+                    failed.append(index)
+
+    await asyncio.gather(*[worker() for _ in range(int(INDEX_BUILD_WORKERS))])
+    if len(failed) > 0:
+        raise Exception(f'{len(failed)} indexes not rebuilt, run again to restore them from {INDEX_STATE_FILE}')
+    if tables is None:
+        os.remove(INDEX_STATE_FILE)
+        print('Restored all indexes recorded in', INDEX_STATE_FILE)
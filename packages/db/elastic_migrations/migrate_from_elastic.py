@@ -1,19 +1,43 @@
 #!/usr/bin/python
 import asyncio
+import calendar
 import hashlib
+import json
 import os
-import uuid
-from datetime import datetime
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import asyncpg
 from elasticsearch import AsyncElasticsearch
 from elasticsearch.helpers import async_scan
 
+# the helpers in packages/db/migration_utils are shared with the other
+# scripts of packages/db
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migration_utils.checkpoint import Checkpoint
+from migration_utils.metrics import metrics
+from migration_utils.profiling import DRY_RUN, PROFILE, PROFILE_SAMPLE_SIZE, explain_async, merge_summaries, print_plan, print_projection
+from migration_utils.throttle import HEALTH_QUERY, AdaptiveThrottle
+from migration_utils.work_queue import AsyncWorkQueue
+
+from batching import ByteBudget, estimate_size
+from conversions import convert_string_to_datetime, get_uuid
+from digests import DigestTree, diff_trees, id_key, prefix_range
+from index_window import drop_indexes, restore_indexes
+from reconcile import composite_page, composite_query, diff_counts
+from snapshot import SnapshotWriter, load_manifest, read_snapshot
+from transform import convert_docs, sanitize_string
+from tsvectors import rebuild_tsvectors
+
 PG_HOST = os.getenv('PG_HOST', 'localhost')
 PG_PORT = os.getenv('PG_PORT', 5432)
 PG_USER = os.getenv('PG_USER', 'app_user')
 PG_PASSWORD = os.getenv('PG_PASSWORD', 'app_pass')
 PG_DB = os.getenv('PG_DB', 'omnivore')
+# initial pause between batches, adapted to the load of the database unless THROTTLE=false
 PG_COOLDOWN_TIME = os.getenv('PG_COOLDOWN_TIME', 1)
 PG_TIMEOUT = os.getenv('PG_TIMEOUT', 60)
 ES_URL = os.getenv('ES_URL', 'http://localhost:9200')
@@ -23,111 +47,240 @@ ES_SCAN_SIZE = os.getenv('ES_SCAN_SIZE', 1000)
 ES_SCROLL_TIME = os.getenv('ES_SCROLL_TIME', '2m')
 ES_INDEX = os.getenv('ES_INDEX', 'pages_alias')
 ES_TIMEOUT = os.getenv('ES_TIMEOUT', 60)
+PG_WRITERS = os.getenv('PG_WRITERS', 4)
+PIPELINE_QUEUE_SIZE = os.getenv('PIPELINE_QUEUE_SIZE', 4)
+# copy: stream batches into temp staging tables and merge them set-based
+# insert: upsert row by row with executemany
+PG_LOAD_MODE = os.getenv('PG_LOAD_MODE', 'copy')
+DEAD_LETTER_FILE = os.getenv('DEAD_LETTER_FILE', 'dead_letters.ndjson')
+CHECKPOINT_FILE = os.getenv('CHECKPOINT_FILE', 'migrate_from_elastic.checkpoint.json')
+# resume from the last committed batch in CHECKPOINT_FILE
+RESUME = os.getenv('RESUME', 'false') == 'true' or '--resume' in sys.argv
+# number of updatedAt ranges scanned and written concurrently
+ES_PARTITIONS = os.getenv('ES_PARTITIONS', 1)
+# number of processes converting docs, 0 converts on the event loop
+CONVERT_WORKERS = os.getenv('CONVERT_WORKERS', os.cpu_count())
+# a batch is flushed at ES_SCAN_SIZE docs or BATCH_BYTES, whichever comes first,
+# ES_SCAN_SIZE is adapted to the load of the database unless THROTTLE=false
+BATCH_BYTES = os.getenv('BATCH_BYTES', 64 * 1024 * 1024)
+# the scan waits while the batches in flight hold more than MAX_INFLIGHT_BYTES
+MAX_INFLIGHT_BYTES = os.getenv('MAX_INFLIGHT_BYTES', 512 * 1024 * 1024)
+
+# migrate: copy the docs to postgres, verify: compare the counts per user,
+# verify_content: compare digests of id, updated_at and readable_content per user
+MODE = os.getenv('MODE', 'migrate')
+# drop the secondary indexes of these tables for the load and rebuild them
+# after, only for a single process, not with WORK_QUEUE
+BULK_WINDOW = os.getenv('BULK_WINDOW', 'false') == 'true' or '--bulk-window' in sys.argv
+BULK_WINDOW_TABLES = ['library_item', 'highlight']
+# name of a shared postgres work queue of per user units, empty runs the
+# time partitions of this process alone
+WORK_QUEUE = os.getenv('WORK_QUEUE', '')
+# units of the work queue migrated at once by this process
+WORK_CONCURRENCY = os.getenv('WORK_CONCURRENCY', 2)
+# the load transactions set omnivore.bulk_load, which skips the modtime and
+# tsvector triggers of library_item (migration 0191). with PG_REPLICA_ROLE
+# they also run with session_replication_role = replica so no trigger fires
+# at all, that needs a superuser (rds_superuser on RDS)
+PG_REPLICA_ROLE = os.getenv('PG_REPLICA_ROLE', 'false') == 'true' or '--replica-role' in sys.argv
+# rebuild the tsvectors, and the derived columns replica mode skips
+TSV_REBUILD = os.getenv('TSV_REBUILD', 'true') == 'true'
+# directory written by MODE=snapshot and read by MODE=replay, which loads
+# postgres from the snapshot without elastic
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshot')
+VERIFY_SAMPLE_RATE = os.getenv('VERIFY_SAMPLE_RATE', 1)
+VERIFY_CONCURRENCY = os.getenv('VERIFY_CONCURRENCY', 4)
+# mismatching ranges of a user drilled into row by row
+VERIFY_MAX_RANGES = os.getenv('VERIFY_MAX_RANGES', 64)
 
 START_TIME = os.getenv('START_TIME', '2000-01-01')
 END_TIME = os.getenv('END_TIME', '2100-01-01')
-# ISO 8601 format
-DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
 
 async def assert_data(db_conn, es_client, user_ids, uploaded_files):
-    # get all users from postgres
+    # reconcile all users in one pass: one GROUP BY query in postgres and a
+    # paginated composite aggregation in elastic, diffed in memory
     try:
-        success = 0
-        failure = 0
-        for user_id in user_ids:
-            number_of_docs_in_postgres = await db_conn.fetchval(
-                f'SELECT COUNT(1) FROM omnivore.library_item WHERE user_id = \'{user_id}\'')
-
-            query = {
-                'size': 0,
-                'query': {
-                    'bool': {
-                        'must': [
-                            {
-                                'term': {
-                                    'userId': user_id
-                                }
-                            }
-                        ],
-                        'should': [
-                            {
-                                'bool': {
-                                    'must_not': {
-                                        'exists': {
-                                            'field': 'uploadFileId'
-                                        }
-                                    }
-                                }
-                            },
-                            {
-                                'terms': {
-                                    'uploadFileId': [file['id'] for file in uploaded_files]
+        print('Counting library items per user in postgres')
+        rows = await db_conn.fetch('''
+            SELECT user_id, COUNT(1) AS count
+            FROM omnivore.library_item
+            WHERE user_id = ANY($1::uuid[])
+            GROUP BY user_id
+        ''', list(user_ids))
+        postgres_counts = {str(row['user_id']): row['count'] for row in rows}
+
+        print('Counting unique urls per user in elastic')
+        query = {
+            'bool': {
+                'should': [
+                    {
+                        'bool': {
+                            'must_not': {
+                                'exists': {
+                                    'field': 'uploadFileId'
                                 }
                             }
-                        ],
-                        'minimum_should_match': 1
-                    }
-                },
-                'aggs': {
-                    'unique_urls': {
-                        'cardinality': {
-                            'field': 'url'
+                        }
+                    },
+                    {
+                        'terms': {
+                            'uploadFileId': [file['id'] for file in uploaded_files]
                         }
                     }
+                ],
+                'minimum_should_match': 1
+            }
+        }
+        aggs = {
+            'unique_urls': {
+                'cardinality': {
+                    'field': 'url'
                 }
             }
-            # Get the count of unique URLs for the specified user
-            result = await es_client.search(index=ES_INDEX, body=query)
-            number_of_docs_in_elastic = result['aggregations']['unique_urls']['value']
+        }
+        elastic_counts = {}
+        after_key = None
+        while True:
+            result = await es_client.search(index=ES_INDEX, body=composite_query(query, 'userId', after_key, aggs),
+                                            request_timeout=int(ES_TIMEOUT))
+            buckets, after_key = composite_page(result)
+            for bucket in buckets:
+                elastic_counts[bucket['key']['userId']] = bucket['unique_urls']['value']
+            if after_key is None:
+                break
 
-            if number_of_docs_in_postgres == number_of_docs_in_elastic:
-                success += 1
-                print(f'User {user_id} OK')
-            else:
-                failure += 1
-                print(
-                    f'User {user_id} ERROR: postgres: {number_of_docs_in_postgres}, elastic: {number_of_docs_in_elastic}')
-        print(f'Asserted data, success: {success}, failure: {failure}')
+        diff_counts(user_ids, postgres_counts, elastic_counts)
     except Exception as err:
         print('Assert data ERROR:', err)
 
 
-def get_uuid(val):
-    try:
-        return uuid.UUID(val)
-    except ValueError:
-        id = convert_string_to_uuid(val)
-        return id
+POSTGRES_DIGEST_QUERY = '''
+    SELECT
+        id,
+        floor(extract(epoch FROM updated_at) * 1000)::bigint AS updated_at,
+        md5(coalesce(readable_content, '')) AS content_md5
+    FROM omnivore.library_item
+    WHERE
+        user_id = $1
+        AND id BETWEEN $2 AND $3
+        -- same window as the elastic side, its bounds are UTC
+        AND updated_at BETWEEN timezone('UTC', $4::text::timestamp) AND timezone('UTC', $5::text::timestamp)
+'''
 
 
-def convert_string_to_uuid(val):
-    hex_string = hashlib.md5(val.encode('UTF-8')).hexdigest()
-    return uuid.UUID(hex=hex_string)
+async def postgres_digest_rows(pool, user_id, low, high, time_range):
+    # stream (id, updated_at, md5(readable_content)) with a server side cursor
+    async with pool.acquire() as db_conn:
+        async with db_conn.transaction():
+            async for row in db_conn.cursor(POSTGRES_DIGEST_QUERY, user_id, low, high,
+                                            time_range['gte'], time_range['lte'],
+                                            prefetch=int(ES_SCAN_SIZE), timeout=int(PG_TIMEOUT)):
+                yield str(row['id']), row['updated_at'], row['content_md5']
 
 
-def convert_string_to_datetime(val):
-    if val is None:
-        return None
-    try:
-        date = datetime.strptime(val, DATE_FORMAT)
-        if date.year <= 1:
-            # avoid year 0 is out of range error
-            return None
-        return date
-    except Exception as err:
-        print('Convert string to datetime ERROR:', err)
-        return None
+async def elastic_digest_rows(es_client, user_id, uploaded_files, time_range):
+    # the same rows computed from elastic the way the migration converts them,
+    # with the migration's filters
+    query = build_query([{'id': user_id}], uploaded_files, time_range)
+    del query['sort']
+    query['_source'] = ['updatedAt', 'content']
+    docs = async_scan(es_client, index=ES_INDEX, query=query, size=ES_SCAN_SIZE,
+                      request_timeout=int(ES_TIMEOUT), scroll=ES_SCROLL_TIME)
+    async for doc in docs:
+        content = doc['_source']['content']
+        if len(content) > 1048575:
+            # skipped by the migration as well
+            continue
+        updated_at = convert_string_to_datetime(doc['_source']['updatedAt'])
+        if updated_at is not None:
+            updated_at = calendar.timegm(updated_at.timetuple()) * 1000 + updated_at.microsecond // 1000
+        content_md5 = hashlib.md5(sanitize_string(content).encode('utf-8')).hexdigest()
+        yield str(get_uuid(doc['_id'])), updated_at, content_md5
 
 
-async def insert_library_items(db_conn, library_items, original_ids):
-    insert_query = '''
-        INSERT INTO omnivore.library_item (
-            id, user_id, title, author, description, readable_content, original_url, upload_file_id, item_type, slug, reading_progress_top_percent, reading_progress_bottom_percent, reading_progress_highest_read_anchor, created_at, saved_at, archived_at, site_name, subscription, state, updated_at, published_at, item_language, read_at, word_count, site_icon, thumbnail, content_reader, original_content, deleted_at
-        )
-        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10,
-                $11, $12, $13, $14, $15, $16, $17, $18, $19,
-                $20, $21, $22, $23, $24, $25, $26, $27, $28, $29)
+async def verify_user_content(pool, es_client, user_id, uploaded_files, time_range):
+    # one sequential read per side builds a digest tree, only the ranges
+    # whose digests differ are read again row by row. both passes read the
+    # updatedAt window the migration copied, rows outside it aren't compared
+    postgres_tree = DigestTree()
+    elastic_tree = DigestTree()
+    low, high = prefix_range('')
+
+    async def read_postgres():
+        async for row in postgres_digest_rows(pool, user_id, low, high, time_range):
+            postgres_tree.add(*row)
+
+    async def read_elastic():
+        async for row in elastic_digest_rows(es_client, user_id, uploaded_files, time_range):
+            elastic_tree.add(*row)
+
+    await asyncio.gather(read_postgres(), read_elastic())
+    leaves = diff_trees(postgres_tree, elastic_tree)
+    if len(leaves) == 0:
+        return True
+
+    print(f'User {user_id} ERROR: {len(leaves)} mismatching ranges, '
+          f'postgres: {postgres_tree.count()}, elastic: {elastic_tree.count()}')
+    if len(leaves) > int(VERIFY_MAX_RANGES):
+        print(f'User {user_id} has more than {VERIFY_MAX_RANGES} mismatching ranges, skipping details')
+        return False
+
+    postgres_rows = {}
+    for leaf in leaves:
+        leaf_low, leaf_high = prefix_range(leaf)
+        async for id, updated_at, content_md5 in postgres_digest_rows(pool, user_id, leaf_low, leaf_high, time_range):
+            postgres_rows[id] = (updated_at, content_md5)
+    elastic_rows = {}
+    leaf_set = set(leaves)
+    async for id, updated_at, content_md5 in elastic_digest_rows(es_client, user_id, uploaded_files, time_range):
+        if id_key(id)[:elastic_tree.depth] in leaf_set:
+            elastic_rows[id] = (updated_at, content_md5)
+
+    for id in sorted(postgres_rows.keys() | elastic_rows.keys()):
+        if id not in elastic_rows:
+            print(f'User {user_id} item {id} is missing in elastic')
+        elif id not in postgres_rows:
+            print(f'User {user_id} item {id} is missing in postgres')
+        elif postgres_rows[id][0] != elastic_rows[id][0]:
+            print(f'User {user_id} item {id} updated_at differs: '
+                  f'postgres: {postgres_rows[id][0]}, elastic: {elastic_rows[id][0]}')
+        elif postgres_rows[id][1] != elastic_rows[id][1]:
+            print(f'User {user_id} item {id} readable_content differs')
+    return False
+
+
+def is_sampled(user_id):
+    # stable sample of VERIFY_SAMPLE_RATE of the users
+    digest = hashlib.md5(str(user_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') < float(VERIFY_SAMPLE_RATE) * (1 << 32)
+
+
+async def verify_content(pool, es_client, user_ids, uploaded_files, time_range):
+    semaphore = asyncio.Semaphore(int(VERIFY_CONCURRENCY))
+    results = {'success': 0, 'failure': 0}
+
+    async def verify(user_id):
+        async with semaphore:
+            if await verify_user_content(pool, es_client, user_id, uploaded_files, time_range):
+                results['success'] += 1
+            else:
+                results['failure'] += 1
+
+    sampled_user_ids = [user_id for user_id in user_ids if is_sampled(user_id)]
+    print(f'Verifying content of {len(sampled_user_ids)} of {len(user_ids)} users')
+    await asyncio.gather(*[verify(user_id) for user_id in sampled_user_ids])
+    print(f'Verified content, success: {results["success"]}, failure: {results["failure"]}')
+
+
+LIBRARY_ITEM_COLUMNS = [
+    'id', 'user_id', 'title', 'author', 'description', 'readable_content', 'original_url', 'upload_file_id',
+    'item_type', 'slug', 'reading_progress_top_percent', 'reading_progress_bottom_percent',
+    'reading_progress_highest_read_anchor', 'created_at', 'saved_at', 'archived_at', 'site_name', 'subscription',
+    'state', 'updated_at', 'published_at', 'item_language', 'read_at', 'word_count', 'site_icon', 'thumbnail',
+    'content_reader', 'original_content', 'deleted_at',
+]
+LIBRARY_ITEM_UPSERT = '''
         ON CONFLICT (user_id, md5(original_url)) DO UPDATE SET
             title = EXCLUDED.title,
             author = EXCLUDED.author,
@@ -154,26 +307,22 @@ async def insert_library_items(db_conn, library_items, original_ids):
             thumbnail = EXCLUDED.thumbnail,
             content_reader = EXCLUDED.content_reader,
             original_content = EXCLUDED.original_content,
-            deleted_at = EXCLUDED.deleted_at
-    '''
-    print(f'Inserting {len(library_items)} library items into postgres')
-    await insert_into_postgres(insert_query, db_conn, library_items, original_ids)
-    print(f'Inserted {len(library_items)} library items')
-
+            deleted_at = EXCLUDED.deleted_at,
+            -- the tsvector trigger is skipped while loading, marks the row
+            -- for the tsvector rebuild
+            search_tsv = NULL
+        -- writers and partitions commit in any order, an older version of
+        -- the item never overwrites a newer one
+        WHERE omnivore.library_item.updated_at IS NULL
+            OR omnivore.library_item.updated_at <= EXCLUDED.updated_at
+'''
 
-async def insert_highlights(db_conn, highlights, original_ids):
-    insert_query = '''
-        INSERT INTO omnivore.highlight (
-            id, user_id, quote, prefix, suffix, patch, annotation, created_at, updated_at, shared_at, short_id, library_item_id, highlight_position_percent, highlight_position_anchor_index, highlight_type, color, html
-        )
-        SELECT
-            $1, $2, $3, $4, $5, $6, $7, $8, $9, $10,
-            $11, $12, $13, $14, $15, $16, $17
-        FROM
-            omnivore.library_item l
-        INNER JOIN omnivore.user u ON u.id = $2
-        WHERE
-            l.id = $12
+HIGHLIGHT_COLUMNS = [
+    'id', 'user_id', 'quote', 'prefix', 'suffix', 'patch', 'annotation', 'created_at', 'updated_at', 'shared_at',
+    'short_id', 'library_item_id', 'highlight_position_percent', 'highlight_position_anchor_index',
+    'highlight_type', 'color', 'html',
+]
+HIGHLIGHT_UPSERT = '''
         ON CONFLICT (id) DO UPDATE SET
             user_id = EXCLUDED.user_id,
             quote = EXCLUDED.quote,
@@ -191,375 +340,794 @@ async def insert_highlights(db_conn, highlights, original_ids):
             highlight_type = EXCLUDED.highlight_type,
             color = EXCLUDED.color,
             html = EXCLUDED.html
-    '''
+        WHERE omnivore.highlight.updated_at IS NULL
+            OR omnivore.highlight.updated_at <= EXCLUDED.updated_at
+'''
+
+LABEL_COLUMNS = ['label_id', 'library_item_id', 'highlight_id']
+LABEL_UPSERT = '''
+        ON CONFLICT (label_id, library_item_id, highlight_id) DO NOTHING
+'''
+
+RECOMMENDATION_COLUMNS = ['library_item_id', 'recommender_id', 'group_id', 'note', 'created_at']
+RECOMMENDATION_UPSERT = '''
+        ON CONFLICT (library_item_id, recommender_id, group_id) DO UPDATE SET
+            note = EXCLUDED.note,
+            created_at = EXCLUDED.created_at
+'''
+
+
+# the joins skip items of users and uploaded files missing in postgres, the
+# foreign keys don't check them in replica mode
+LIBRARY_ITEM_INSERT = f'''
+    INSERT INTO omnivore.library_item (
+        {', '.join(LIBRARY_ITEM_COLUMNS)}
+    )
+    SELECT
+        $1, $2, $3, $4, $5, $6, $7, $8, $9, $10,
+        $11, $12, $13, $14, $15, $16, $17, $18, $19,
+        $20, $21, $22, $23, $24, $25, $26, $27, $28, $29
+    FROM
+        omnivore.user u
+    LEFT JOIN omnivore.upload_files f ON f.id = $8
+    WHERE
+        u.id = $2 AND ($8 IS NULL OR f.id IS NOT NULL)
+    {LIBRARY_ITEM_UPSERT}
+'''
+# keep the latest version of a duplicated url, an upsert cannot
+# touch the same row twice in one statement
+LIBRARY_ITEM_MERGE = f'''
+    INSERT INTO omnivore.library_item (
+        {', '.join(LIBRARY_ITEM_COLUMNS)}
+    )
+    SELECT DISTINCT ON (s.user_id, md5(s.original_url))
+        {', '.join('s.' + column for column in LIBRARY_ITEM_COLUMNS)}
+    FROM staging_library_item s
+    INNER JOIN omnivore.user u ON u.id = s.user_id
+    LEFT JOIN omnivore.upload_files f ON f.id = s.upload_file_id
+    WHERE s.upload_file_id IS NULL OR f.id IS NOT NULL
+    ORDER BY s.user_id, md5(s.original_url), s.updated_at DESC NULLS LAST
+    {LIBRARY_ITEM_UPSERT}
+'''
+
+HIGHLIGHT_INSERT = f'''
+    INSERT INTO omnivore.highlight (
+        {', '.join(HIGHLIGHT_COLUMNS)}
+    )
+    SELECT
+        $1, $2, $3, $4, $5, $6, $7, $8, $9, $10,
+        $11, $12, $13, $14, $15, $16, $17
+    FROM
+        omnivore.library_item l
+    INNER JOIN omnivore.user u ON u.id = $2
+    WHERE
+        l.id = $12
+    {HIGHLIGHT_UPSERT}
+'''
+HIGHLIGHT_MERGE = f'''
+    INSERT INTO omnivore.highlight (
+        {', '.join(HIGHLIGHT_COLUMNS)}
+    )
+    SELECT DISTINCT ON (s.id)
+        {', '.join('s.' + column for column in HIGHLIGHT_COLUMNS)}
+    FROM staging_highlight s
+    INNER JOIN omnivore.library_item l ON l.id = s.library_item_id
+    INNER JOIN omnivore.user u ON u.id = s.user_id
+    ORDER BY s.id, s.updated_at DESC NULLS LAST
+    {HIGHLIGHT_UPSERT}
+'''
+
+LABEL_INSERT = f'''
+    INSERT INTO omnivore.entity_labels (
+        label_id, library_item_id, highlight_id
+    )
+    SELECT $1, $2, $3
+    FROM omnivore.labels l
+    LEFT JOIN omnivore.library_item li ON li.id = $2
+    LEFT JOIN omnivore.highlight h ON h.id = $3
+    WHERE l.id = $1 AND ($2 IS NULL OR li.id = $2) AND ($3 IS NULL OR h.id = $3)
+    {LABEL_UPSERT}
+'''
+LABEL_MERGE = f'''
+    INSERT INTO omnivore.entity_labels (
+        label_id, library_item_id, highlight_id
+    )
+    SELECT s.label_id, s.library_item_id, s.highlight_id
+    FROM staging_entity_labels s
+    INNER JOIN omnivore.labels l ON l.id = s.label_id
+    LEFT JOIN omnivore.library_item li ON li.id = s.library_item_id
+    LEFT JOIN omnivore.highlight h ON h.id = s.highlight_id
+    WHERE (s.library_item_id IS NULL OR li.id IS NOT NULL) AND (s.highlight_id IS NULL OR h.id IS NOT NULL)
+    {LABEL_UPSERT}
+'''
+
+RECOMMENDATION_INSERT = f'''
+    INSERT INTO omnivore.recommendation (
+        library_item_id, recommender_id, group_id, note, created_at
+    )
+    SELECT $1, $2, $3, $4, $5
+    FROM omnivore.library_item li
+    INNER JOIN omnivore.user u ON u.id = $2
+    INNER JOIN omnivore.group g ON g.id = $3
+    WHERE li.id = $1
+    {RECOMMENDATION_UPSERT}
+'''
+RECOMMENDATION_MERGE = f'''
+    INSERT INTO omnivore.recommendation (
+        library_item_id, recommender_id, group_id, note, created_at
+    )
+    SELECT DISTINCT ON (s.library_item_id, s.recommender_id, s.group_id)
+        s.library_item_id, s.recommender_id, s.group_id, s.note, s.created_at
+    FROM staging_recommendation s
+    INNER JOIN omnivore.library_item li ON li.id = s.library_item_id
+    INNER JOIN omnivore.user u ON u.id = s.recommender_id
+    INNER JOIN omnivore.group g ON g.id = s.group_id
+    ORDER BY s.library_item_id, s.recommender_id, s.group_id, s.created_at DESC NULLS LAST
+    {RECOMMENDATION_UPSERT}
+'''
+
+# batch key, table, columns, row insert and staging merge, in dependency order
+# so highlights, labels and recommendations can join against the library items
+TABLES = [
+    ('library_items', 'library_item', LIBRARY_ITEM_COLUMNS, LIBRARY_ITEM_INSERT, LIBRARY_ITEM_MERGE),
+    ('highlights', 'highlight', HIGHLIGHT_COLUMNS, HIGHLIGHT_INSERT, HIGHLIGHT_MERGE),
+    ('labels', 'entity_labels', LABEL_COLUMNS, LABEL_INSERT, LABEL_MERGE),
+    ('recommendations', 'recommendation', RECOMMENDATION_COLUMNS, RECOMMENDATION_INSERT, RECOMMENDATION_MERGE),
+]
+
+
+async def insert_library_items(db_conn, library_items, original_ids):
+    print(f'Inserting {len(library_items)} library items into postgres')
+    await load_into_postgres('library_item', LIBRARY_ITEM_COLUMNS, LIBRARY_ITEM_INSERT, LIBRARY_ITEM_MERGE,
+                             db_conn, library_items, original_ids)
+    print(f'Inserted {len(library_items)} library items')
+
+
+async def insert_highlights(db_conn, highlights, original_ids):
     print(f'Inserting {len(highlights)} highlights into postgres')
-    await insert_into_postgres(insert_query, db_conn, highlights, original_ids)
+    await load_into_postgres('highlight', HIGHLIGHT_COLUMNS, HIGHLIGHT_INSERT, HIGHLIGHT_MERGE,
+                             db_conn, highlights, original_ids)
     print(f'Inserted {len(highlights)} highlights')
 
 
 async def insert_labels(db_conn, labels, original_ids):
-    insert_query = '''
-        INSERT INTO omnivore.entity_labels (
-            label_id, library_item_id, highlight_id
-        )
-        SELECT $1, $2, $3
-        FROM omnivore.labels l
-        LEFT JOIN omnivore.library_item li ON li.id = $2
-        LEFT JOIN omnivore.highlight h ON h.id = $3
-        WHERE l.id = $1 AND ($2 IS NULL OR li.id = $2) AND ($3 IS NULL OR h.id = $3)
-        ON CONFLICT (label_id, library_item_id, highlight_id) DO NOTHING
-    '''
     print(f'Inserting {len(labels)} labels into postgres')
-    await insert_into_postgres(insert_query, db_conn, labels, original_ids)
+    await load_into_postgres('entity_labels', LABEL_COLUMNS, LABEL_INSERT, LABEL_MERGE,
+                             db_conn, labels, original_ids)
     print(f'Inserted {len(labels)} labels')
 
 
 async def insert_recommendations(db_conn, recommendations, original_ids):
-    insert_query = '''
-        INSERT INTO omnivore.recommendation (
-            library_item_id, recommender_id, group_id, note, created_at
-        )
-        SELECT $1, $2, $3, $4, $5
-        FROM omnivore.library_item li
-        INNER JOIN omnivore.user u ON u.id = $2
-        INNER JOIN omnivore.group g ON g.id = $3
-        WHERE li.id = $1
-        ON CONFLICT (library_item_id, recommender_id, group_id) DO UPDATE SET
-            note = EXCLUDED.note,
-            created_at = EXCLUDED.created_at
-    '''
     print(f'Inserting {len(recommendations)} recommendations into postgres')
-    await insert_into_postgres(insert_query, db_conn, recommendations, original_ids)
+    await load_into_postgres('recommendation', RECOMMENDATION_COLUMNS, RECOMMENDATION_INSERT, RECOMMENDATION_MERGE,
+                             db_conn, recommendations, original_ids)
     print(f'Inserted {len(recommendations)} recommendations')
 
 
-async def insert_into_postgres(insert_query, db_conn, records, original_ids):
-    sanitized_records = sanitize_tuples(records)
+async def load_into_postgres(table, columns, insert_query, merge_query, db_conn, records, original_ids):
+    # rows_written counts the rows the statements inserted or updated, not
+    # the records dropped by the joins, merged as duplicates or dead lettered
+    started_at = time.time()
+    try:
+        if PG_LOAD_MODE == 'copy':
+            try:
+                written = await copy_into_postgres(table, columns, merge_query, db_conn, records)
+                metrics.inc('rows_written', written, table=table)
+                return
+            except Exception as err:
+                # fall back to row based inserts to find and handle the bad records
+                print('Copy into postgres ERROR:', err)
+                metrics.inc('copy_fallbacks', table=table)
+
+        written = await insert_into_postgres(table, insert_query, db_conn, records, original_ids)
+        metrics.inc('rows_written', written, table=table)
+    finally:
+        metrics.observe('write', time.time() - started_at, table=table)
+
+
+async def copy_into_staging(table, columns, db_conn, records):
+    # temp tables are unlogged and private to the connection, rows are
+    # dropped again when the transaction commits
+    staging_table = f'staging_{table}'
+    await db_conn.execute(f'''
+        CREATE TEMP TABLE IF NOT EXISTS {staging_table} ON COMMIT DELETE ROWS AS
+        SELECT {', '.join(columns)} FROM omnivore.{table} WITH NO DATA
+    ''')
+    await db_conn.copy_records_to_table(staging_table, records=records,
+                                        columns=columns, timeout=int(PG_TIMEOUT))
+
+
+async def begin_load(db_conn):
+    # for this transaction only, so the app keeps its triggers and no ALTER
+    # TABLE locks the tables. the updated_at copied from elastic is kept and
+    # content too diverse for a tsvector can't fail the insert, the rebuild
+    # cuts it to fit
+    await db_conn.execute("SET LOCAL omnivore.bulk_load = 'on'")
+    if PG_REPLICA_ROLE:
+        await db_conn.execute("SET LOCAL session_replication_role = 'replica'")
+
+
+def affected_rows(status):
+    # the command tag of an INSERT is 'INSERT 0 <rows>'
+    return int(status.split()[-1])
 
+
+async def copy_into_postgres(table, columns, merge_query, db_conn, records):
+    # returns the rows the merge inserted or updated
+    async with db_conn.transaction():
+        await begin_load(db_conn)
+        await copy_into_staging(table, columns, db_conn, records)
+        return affected_rows(await db_conn.execute(merge_query, timeout=int(PG_TIMEOUT)))
+
+
+async def insert_into_postgres(table, insert_query, db_conn, records, original_ids):
+    async with db_conn.transaction():
+        await begin_load(db_conn)
+        return await insert_or_bisect(table, insert_query, db_conn, records, original_ids)
+
+
+async def insert_or_bisect(table, insert_query, db_conn, records, original_ids):
+    # insert the records in bulk and split a failed slice in halves until the
+    # bad records are isolated, k bad records cost O(k * log n) round trips.
+    # returns the rows inserted or updated
     try:
-        await db_conn.executemany(insert_query, sanitized_records, timeout=int(PG_TIMEOUT))
+        # nested transactions are savepoints, a failure only rolls back this slice
+        async with db_conn.transaction():
+            if len(records) == 1:
+                return affected_rows(await db_conn.execute(insert_query, *records[0], timeout=int(PG_TIMEOUT)))
+            # fetchmany (asyncpg 0.30) runs the statement per record like
+            # executemany and returns a row for every row it wrote
+            return len(await db_conn.fetchmany(f'{insert_query} RETURNING 1', records, timeout=int(PG_TIMEOUT)))
     except Exception as err:
-        print('Batch insert into postgres ERROR:', err)
-        # excute insert query one by one if batch insert failed
-        for i, record in enumerate(sanitized_records):
-            # print original id for debugging
-            print('Inserting record', original_ids[i])
+        if len(records) == 1:
+            await insert_failed_record(table, insert_query, db_conn, records[0], original_ids[0], err)
+            return 0
+        print(f'Batch insert of {len(records)} records into postgres ERROR:', err)
+        metrics.inc('retries', table=table)
+
+    middle = len(records) // 2
+    return (await insert_or_bisect(table, insert_query, db_conn, records[:middle], original_ids[:middle]) +
+            await insert_or_bisect(table, insert_query, db_conn, records[middle:], original_ids[middle:]))
+
+
+async def insert_failed_record(table, insert_query, db_conn, record, original_id, err):
+    print('Insert into postgres ERROR:', original_id, err)
+    if 'duplicate key value violates unique constraint' in str(err):
+        # skip the error
+        print('Skipping duplicate record', original_id)
+        metrics.inc('duplicates_skipped', table=table)
+        return
+
+    write_dead_letter(table, record, original_id, err)
+
+
+def write_dead_letter(table, record, original_id, err):
+    # keep the rejected record around so it can be fixed and replayed later
+    print('Writing record', original_id, 'to', DEAD_LETTER_FILE)
+    metrics.inc('dead_letters', table=table)
+    with open(DEAD_LETTER_FILE, 'a') as f:
+        f.write(json.dumps({
+            'table': table,
+            'original_id': original_id,
+            'error': str(err),
+            'record': list(record),
+        }, default=str) + '\n')
+
+
+async def write_batch(db_conn, batch):
+    # library items go first so highlights, labels and recommendations
+    # of the same batch can join against them
+    library_items, library_items_original_ids = batch['library_items']
+    if len(library_items) > 0:
+        await insert_library_items(db_conn, library_items, library_items_original_ids)
+    highlights, highlights_original_ids = batch['highlights']
+    if len(highlights) > 0:
+        await insert_highlights(db_conn, highlights, highlights_original_ids)
+    labels, labels_original_ids = batch['labels']
+    if len(labels) > 0:
+        await insert_labels(db_conn, labels, labels_original_ids)
+    recommendations, recommendations_original_ids = batch['recommendations']
+    if len(recommendations) > 0:
+        await insert_recommendations(db_conn, recommendations, recommendations_original_ids)
+
+
+async def scan_stage(docs, scan_queue, budget, throttle):
+    # read docs from elastic in batches and hand them over to the converter
+    # without waiting for postgres
+    page = []
+    page_bytes = 0
+    async for doc in docs:
+        # skip item if content is larger than 1MB, before it is buffered
+        if len(doc['_source']['content']) > 1048575:
+            print('Skipping item', doc['_id'], 'because content is larger than 1MB')
+            metrics.inc('docs_skipped')
+            continue
+        page.append(doc)
+        page_bytes += estimate_size(doc)
+        if len(page) >= throttle.batch_size or page_bytes >= int(BATCH_BYTES):
+            await hand_over(page, page_bytes, scan_queue, budget)
+            page = []
+            page_bytes = 0
+    if len(page) > 0:
+        await hand_over(page, page_bytes, scan_queue, budget)
+    await scan_queue.put(None)
+
+
+async def hand_over(page, page_bytes, scan_queue, budget):
+    metrics.inc('docs_scanned', len(page))
+    metrics.inc('bytes_scanned', page_bytes)
+    # back pressure, wait for the writers to release memory. the time spent
+    # waiting here shows when the scan is not the bottleneck
+    started_at = time.time()
+    await budget.acquire(page_bytes)
+    await scan_queue.put((page, page_bytes))
+    metrics.observe('scan_backpressure', time.time() - started_at)
+
+
+def submit_conversion(executor, docs):
+    loop = asyncio.get_event_loop()
+    started_at = time.time()
+    if executor is None:
+        future = loop.create_future()
+        future.set_result(convert_docs(docs))
+        record_conversion(started_at, len(docs))
+        return future
+    future = loop.run_in_executor(executor, convert_docs, docs)
+    future.add_done_callback(lambda _: record_conversion(started_at, len(docs)))
+    return future
+
+
+def record_conversion(started_at, docs):
+    # includes the time the batch waited for a free worker process
+    metrics.observe('convert', time.time() - started_at)
+    metrics.inc('docs_converted', docs)
+
+
+async def convert_stage(scan_queue, write_queue, executor):
+    # keep up to CONVERT_WORKERS batches converting in parallel and hand
+    # them to the writers in scan order
+    pending = deque()
+    sequence = 0
+    while True:
+        item = await scan_queue.get()
+        if item is None:
+            break
+        docs, batch_bytes = item
+        # remember where the batch ends in the sort order for the checkpoint
+        pending.append((sequence, len(docs), docs[-1].get('sort'), batch_bytes, submit_conversion(executor, docs)))
+        sequence += 1
+        if len(pending) >= max(int(CONVERT_WORKERS), 1):
+            *batch_info, future = pending.popleft()
+            await write_queue.put((*batch_info, await future))
+    while len(pending) > 0:
+        *batch_info, future = pending.popleft()
+        await write_queue.put((*batch_info, await future))
+    # one stop signal per writer
+    for _ in range(int(PG_WRITERS)):
+        await write_queue.put(None)
+
+
+async def write_stage(pool, write_queue, budget, throttle, progress, checkpoint, key):
+    while True:
+        item = await write_queue.get()
+        if item is None:
+            break
+        sequence, scanned, search_after, batch_bytes, batch = item
+        started_at = time.time()
+        async with pool.acquire() as db_conn:
+            await write_batch(db_conn, batch)
+            if throttle.health_due():
+                throttle.update_health(*await db_conn.fetchrow(HEALTH_QUERY))
+        throttle.record(time.time() - started_at)
+        metrics.observe('batch', time.time() - started_at)
+        metrics.inc('docs_processed', scanned)
+        metrics.inc('bytes_written', batch_bytes)
+        await budget.release(batch_bytes)
+        if checkpoint is not None:
+            checkpoint.commit(key, sequence, search_after, scanned)
+        progress['copied'] += scanned
+        print('Copied', progress['copied'], 'records to postgres,', 'batch of', scanned, 'docs,', batch_bytes, 'bytes')
+        # back off while postgres or its replicas are under pressure
+        if throttle.pause > 0:
+            await asyncio.sleep(throttle.pause)
+
+
+async def run_stages(*stages):
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # a failed stage would leave the others blocked on the queues
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def migration_time_range():
+    # the updatedAt window of the run, the partitions split it and the
+    # verification compares the same window
+    return {'gte': START_TIME, 'lte': END_TIME}
+
+
+def build_query(users, uploaded_files, time_range):
+    return {
+        'query': {
+            'bool': {
+                'must': [
+                    {
+                        'range': {
+                            'updatedAt': time_range
+                        }
+                    },
+                    {
+                        'terms': {
+                            'userId': [user['id'] for user in users]
+                        },
+                    },
+                ],
+                'should': [
+                    {
+                        'bool': {
+                            'must_not': {
+                                'exists': {
+                                    'field': 'uploadFileId'
+                                }
+                            }
+                        },
+                    },
+                    {
+                        'terms': {
+                            'uploadFileId': [file['id'] for file in uploaded_files]
+                        }
+                    }
+                ],
+                'minimum_should_match': 1,
+            }
+        },
+        'sort': [
+            {
+                'updatedAt': {
+                    'order': 'asc'
+                }
+            }
+        ]
+    }
+
+
+async def split_time_range(es_client, users, uploaded_files, partitions):
+    # split START_TIME..END_TIME in ranges holding about the same number of
+    # docs, updatedAt is far from uniform so equal length buckets would not do
+    time_range = migration_time_range()
+    if partitions <= 1:
+        return [time_range]
+
+    result = await es_client.search(index=ES_INDEX, body={
+        'size': 0,
+        'query': build_query(users, uploaded_files, time_range)['query'],
+        'aggs': {
+            'updated_at': {
+                'percentiles': {
+                    'field': 'updatedAt',
+                    'percents': [100 * i / partitions for i in range(1, partitions)],
+                    'keyed': False,
+                }
+            }
+        }
+    }, request_timeout=int(ES_TIMEOUT))
+
+    # the bounds are the percentiles formatted as updatedAt is, like
+    # START_TIME and END_TIME, the mapping may not accept epoch millis
+    bounds = sorted(set(percentile['value_as_string'] for percentile in result['aggregations']['updated_at']['values']
+                        if percentile.get('value') is not None))
+    ranges = []
+    lower = START_TIME
+    for bound in bounds:
+        ranges.append({'gte': lower, 'lt': bound})
+        lower = bound
+    ranges.append({'gte': lower, 'lte': END_TIME})
+    return ranges
+
+
+async def migrate_partition(pool, es_client, executor, budget, throttle, checkpoint, key, query, progress):
+    partition = checkpoint.partition(key)
+    if partition['done']:
+        print('Partition', key, 'already complete according to', CHECKPOINT_FILE)
+        return
+
+    print('Migrating partition', key, partition['range'])
+    if partition['search_after'] is not None:
+        # restart from the updatedAt of the last committed doc, the docs sharing
+        # it are copied again which the upserts make harmless, and no tie
+        # breaker on _id is needed, sorting on _id loads its fielddata
+        print('Resuming partition', key, 'from', partition['search_after'])
+        query['query']['bool']['must'].append({
+            'range': {
+                'updatedAt': {
+                    'gte': partition['search_after'][0],
+                    'format': 'epoch_millis',
+                }
+            }
+        })
+    # Scan API for larger library, order only matters inside the partition
+    docs = async_scan(es_client, index=ES_INDEX, query=query,
+                      preserve_order=True, size=ES_SCAN_SIZE,
+                      request_timeout=int(ES_TIMEOUT), scroll=ES_SCROLL_TIME)
+
+    await run_pipeline(pool, docs, executor, budget, throttle, progress, checkpoint, key)
+    checkpoint.finish(key)
+    print('Partition', key, 'complete')
+
+
+async def run_pipeline(pool, docs, executor, budget, throttle, progress, checkpoint=None, key=None):
+    # scan, convert and write run concurrently, linked by bounded queues
+    # so the slowest stage sets the pace instead of the sum of all stages
+    scan_queue = asyncio.Queue(maxsize=int(PIPELINE_QUEUE_SIZE))
+    write_queue = asyncio.Queue(maxsize=int(PIPELINE_QUEUE_SIZE))
+    await run_stages(
+        scan_stage(docs, scan_queue, budget, throttle),
+        convert_stage(scan_queue, write_queue, executor),
+        *[write_stage(pool, write_queue, budget, throttle, progress, checkpoint, key) for _ in range(int(PG_WRITERS))],
+    )
+
+
+async def migrate_from_queue(pool, es_client, executor, throttle, users, uploaded_files, progress):
+    # one unit per user, claimed by any number of processes sharing WORK_QUEUE,
+    # so a large library only occupies one worker. units restart from the
+    # beginning when retried, the upserts make that safe
+    queue = AsyncWorkQueue(pool, WORK_QUEUE)
+    # every process enqueues all users, units already queued are kept as they are
+    await queue.enqueue([(user['id'], {'user_id': user['id']}) for user in users])
+
+    async def worker():
+        while True:
+            unit = await queue.claim()
+            if unit is None:
+                return
+            key, payload, attempts = unit
+            print('Migrating user', key, 'attempt', attempts)
+            query = build_query([{'id': payload['user_id']}], uploaded_files,
+                                migration_time_range())
+            docs = async_scan(es_client, index=ES_INDEX, query=query,
+                              preserve_order=True, size=ES_SCAN_SIZE,
+                              request_timeout=int(ES_TIMEOUT), scroll=ES_SCROLL_TIME)
+            # a budget per unit, a failed unit can't leak the memory of the others
+            budget = ByteBudget(int(MAX_INFLIGHT_BYTES) // int(WORK_CONCURRENCY))
+            work = asyncio.ensure_future(run_pipeline(pool, docs, executor, budget, throttle, progress))
+            lease = asyncio.ensure_future(queue.hold(key, work))
             try:
-                await db_conn.execute(insert_query, *record, timeout=int(PG_TIMEOUT))
+                await work
+                await queue.complete(key)
+                print('User', key, 'complete')
+            except asyncio.CancelledError:
+                # a finished lease task cancelled the unit, anything else
+                # cancels this worker
+                if not lease.done():
+                    raise
+                print('Work unit', key, 'left to the worker holding its lease')
             except Exception as err:
-                # print the error
-                print('Insert into postgres ERROR:', err)
-                if 'string is too long for tsvector' in str(err):
-                    # create a transaction
-                    async with db_conn.transaction():
-                        # disable library_item_tsv_update trigger
-                        await db_conn.execute('ALTER TABLE omnivore.library_item DISABLE TRIGGER library_item_tsv_update')
-                        # insert record again
-                        await db_conn.execute(insert_query, *record, timeout=int(PG_TIMEOUT))
-                        # enable library_item_tsv_update trigger
-                        await db_conn.execute('ALTER TABLE omnivore.library_item ENABLE TRIGGER library_item_tsv_update')
-                elif 'duplicate key value violates unique constraint' in str(err):
-                    # skip the error
-                    print('Skipping duplicate record', original_ids[i])
-                    continue
-                else:
-                    # throw the error
-                    raise err
+                print('Work unit', key, 'ERROR:', err)
+                await queue.fail(key, err)
+            finally:
+                lease.cancel()
 
-    # cool down for PG_COOLDOWN_TIME seconds
-    if float(PG_COOLDOWN_TIME) > 0:
-        await asyncio.sleep(float(PG_COOLDOWN_TIME))
+    await asyncio.gather(*[worker() for _ in range(int(WORK_CONCURRENCY))])
+    summary = await queue.summary()
+    print('Work queue', WORK_QUEUE, summary)
+    return summary
 
 
-def sanitize_tuples(tuples):
-    sanitize_tuples = []
-    for tuple in tuples:
-        sanitize_tuple = []
-        for val in tuple:
-            sanitize_tuple.append(sanitize_string(val))
-        sanitize_tuples.append(sanitize_tuple)
-    return sanitize_tuples
+async def write_snapshot(es_client, users, uploaded_files):
+    # dump the docs the migration would copy, in the same order
+    query = build_query(users, uploaded_files, migration_time_range())
+    writer = SnapshotWriter(SNAPSHOT_DIR, {
+        'source': 'elastic',
+        'index': ES_INDEX,
+        'start_time': START_TIME,
+        'end_time': END_TIME,
+    })
+    docs = []
+    async for doc in async_scan(es_client, index=ES_INDEX, query=query,
+                                preserve_order=True, size=ES_SCAN_SIZE,
+                                request_timeout=int(ES_TIMEOUT), scroll=ES_SCROLL_TIME):
+        docs.append(doc)
+        if len(docs) >= int(ES_SCAN_SIZE):
+            writer.write(docs)
+            docs = []
+    writer.write(docs)
+    writer.close()
 
 
-def sanitize_string(val):
-    # sanitize valu if val is a string
-    if isinstance(val, str):
-        return replace_surrogates(remove_null_bytes(val))
-    return val
+async def snapshot_docs(skip):
+    # feeds the snapshot to the scan stage as if it came from elastic
+    for doc in read_snapshot(SNAPSHOT_DIR, skip):
+        yield doc
 
 
-def remove_null_bytes(val):
-    if val is None:
-        return None
-    return val.replace('\u0000', '')
+async def replay_snapshot(pool, executor, budget, throttle, checkpoint, progress):
+    # snapshot docs carry no sort values, the checkpoint resumes by skipping
+    # the docs already copied, the snapshot order never changes
+    partition = checkpoint.partition(0)
+    if partition['done']:
+        print('Snapshot', SNAPSHOT_DIR, 'already replayed according to', CHECKPOINT_FILE)
+        return
+    print(f'Replaying {load_manifest(SNAPSHOT_DIR)["docs"]} docs from {SNAPSHOT_DIR}, skipping {partition["copied"]}')
+    await run_pipeline(pool, snapshot_docs(partition['copied']), executor, budget, throttle, progress, checkpoint, 0)
+    checkpoint.finish(0)
+    print('Snapshot', SNAPSHOT_DIR, 'replayed')
 
 
-def replace_surrogates(val):
-    if val is None:
-        return None
-    return val.encode('utf-8', 'replace').decode('utf-8')
+async def profile_migration(pool, es_client, users, uploaded_files):
+    # convert and load one sample page inside a transaction that is always
+    # rolled back, then project the measured cost onto all docs to migrate
+    query = build_query(users, uploaded_files, migration_time_range())
+    total = await count_docs(es_client, users, uploaded_files)
+    print(f'[dry-run] docs to migrate: {total}')
+
+    result = await es_client.search(index=ES_INDEX, body=query, size=int(PROFILE_SAMPLE_SIZE),
+                                    request_timeout=int(ES_TIMEOUT))
+    docs = [doc for doc in result['hits']['hits'] if len(doc['_source']['content']) <= 1048575]
+    if len(docs) == 0:
+        print('[dry-run] no docs to sample')
+        return
+    batch = convert_docs(docs)
+
+    async with pool.acquire() as db_conn:
+        transaction = db_conn.transaction()
+        await transaction.start()
+        try:
+            for key, table, columns, insert_query, merge_query in TABLES:
+                records, _ = batch[key]
+                if len(records) == 0:
+                    continue
+                if PG_LOAD_MODE == 'copy':
+                    await copy_into_staging(table, columns, db_conn, records)
+                    summary = await explain_async(db_conn, merge_query, analyze=PROFILE)
+                else:
+                    summary = merge_summaries([await explain_async(db_conn, insert_query, record, analyze=PROFILE)
+                                               for record in records])
+                print_plan(table, summary)
+                if PROFILE:
+                    print_projection(table, summary, len(docs), total)
+        finally:
+            await transaction.rollback()
+
+
+async def count_docs(es_client, users, uploaded_files):
+    query = build_query(users, uploaded_files, migration_time_range())
+    result = await es_client.count(index=ES_INDEX, body={'query': query['query']},
+                                   request_timeout=int(ES_TIMEOUT))
+    return result['count']
 
 
 async def main():
     print('Starting migration', START_TIME, END_TIME)
+    if BULK_WINDOW and WORK_QUEUE:
+        # the window is opened and closed by one process with its state file
+        # on one host, processes sharing a queue would restore the indexes
+        # while the others are still loading
+        print('BULK_WINDOW can not be used with WORK_QUEUE')
+        exit(1)
+    metrics.start('migrate_from_elastic')
 
-    # postgres connection
-    db_conn = await asyncpg.connect(user=PG_USER, password=PG_PASSWORD,
-                                    database=PG_DB, host=PG_HOST, port=PG_PORT,
-                                    timeout=int(PG_TIMEOUT))
+    # postgres connection pool, one connection per writer of every partition
+    pool = await asyncpg.create_pool(user=PG_USER, password=PG_PASSWORD,
+                                     database=PG_DB, host=PG_HOST, port=PG_PORT,
+                                     timeout=int(PG_TIMEOUT),
+                                     min_size=1,
+                                     max_size=int(PG_WRITERS) * max(int(ES_PARTITIONS), int(WORK_CONCURRENCY)) + 1)
 
     # elastic client
     es_client = AsyncElasticsearch(ES_URL, http_auth=(
         ES_USERNAME, ES_PASSWORD), retry_on_timeout=True)
 
-    try:
-        # updated_user_ids = []
+    # the transform is CPU bound, run it in worker processes so it doesn't
+    # starve the network I/O of the event loop
+    executor = ProcessPoolExecutor(int(CONVERT_WORKERS)) if int(CONVERT_WORKERS) > 0 else None
 
-        print(await es_client.info())
+    if MODE == 'replay':
+        checkpoint = Checkpoint(CHECKPOINT_FILE, {'snapshot': SNAPSHOT_DIR})
+    else:
+        checkpoint = Checkpoint(CHECKPOINT_FILE, {
+            'index': ES_INDEX,
+            'start_time': START_TIME,
+            'end_time': END_TIME,
+            'partitions': int(ES_PARTITIONS),
+        })
+    window_open = False
 
-        # disable update_library_item_modtime trigger
-        await db_conn.execute('ALTER TABLE omnivore.library_item DISABLE TRIGGER update_library_item_modtime')
+    try:
+        # a replay runs without elastic
+        if MODE != 'replay':
+            print(await es_client.info())
+
+        if RESUME:
+            checkpoint.resume()
 
         print('Getting list of users from postgres')
-        users = await db_conn.fetch('SELECT id FROM omnivore.user')
+        users = await pool.fetch('SELECT id FROM omnivore.user')
 
         print('Getting list of uploaded files from postgres')
-        uploaded_files = await db_conn.fetch('SELECT id FROM omnivore.upload_files')
-
-        print('Getting data from elastic and if uploadFileId exists, check if it exists in postgres')
-        i = 0
-        library_items = []
-        library_items_original_ids = []
-        highlights = []
-        highlights_original_ids = []
-        labels = []
-        labels_original_ids = []
-        recommendations = []
-        recommendations_original_ids = []
+        uploaded_files = await pool.fetch('SELECT id FROM omnivore.upload_files')
 
-        query = {
-            'query': {
-                'bool': {
-                    'must': [
-                        {
-                            'range': {
-                                'updatedAt': {
-                                    'gte': START_TIME,
-                                    'lte': END_TIME,
-                                }
-                            }
-                        },
-                        {
-                            'terms': {
-                                'userId': [user['id'] for user in users]
-                            },
-                        },
-                    ],
-                    'should': [
-                        {
-                            'bool': {
-                                'must_not': {
-                                    'exists': {
-                                        'field': 'uploadFileId'
-                                    }
-                                }
-                            },
-                        },
-                        {
-                            'terms': {
-                                'uploadFileId': [file['id'] for file in uploaded_files]
-                            }
-                        }
-                    ],
-                    'minimum_should_match': 1,
-                }
-            },
-            'sort': [
-                {
-                    'updatedAt': {
-                        'order': 'asc'
-                    }
-                }
-            ]
-        }
-        # Scan API for larger library
-        docs = async_scan(es_client, index=ES_INDEX, query=query,
-                          preserve_order=True, size=ES_SCAN_SIZE,
-                          request_timeout=int(ES_TIMEOUT), scroll=ES_SCROLL_TIME)
-
-        # convert _id to uuid
-        async for doc in docs:
-            i += 1
-            doc_id = doc['_id']
-            id = get_uuid(doc_id)
-
-            # convert library items to postgres format
-            source = doc['_source']
-            subscription = source['subscription'] if 'subscription' in source else source.get('rssFeedUrl', None)
-            page_type = source['pageType']
-            content_reader = 'WEB'
-            if 'uploadFileId' in source:
-                if page_type == 'BOOK':
-                    content_reader = 'EPUB'
-                elif page_type == 'FILE':
-                    content_reader = 'PDF'
-            updated_at = convert_string_to_datetime(source['updatedAt'])
-            state = source['state']
-            deleted_at = updated_at if state == 'DELETED' else None
-            reading_progress_top_percent = source.get('readingProgressTopPercent', 0)
-            reading_progress_percent = source.get('readingProgressPercent', 0)
-            reading_progress_anchor = source.get('readingProgressAnchorIndex', 0)
-            content = source['content']
-            original_html = source.get('originalHtml', None)
-            description = source.get('description', None)
-            user_id = get_uuid(source['userId'])
-
-            # skip item if content is larger than 1MB
-            if len(content) > 1048575:
-                print('Skipping item', doc_id, 'because content is larger than 1MB')
-                continue
-
-            library_item = (
-                id,
-                user_id,
-                source['title'],
-                source.get('author', None),
-                description,
-                content,
-                source['url'],
-                source.get('uploadFileId', None),
-                page_type if page_type is not None else 'UNKNOWN',
-                source['slug'],
-                reading_progress_top_percent if reading_progress_top_percent is not None else 0,
-                reading_progress_percent if reading_progress_percent is not None else 0,
-                reading_progress_anchor if reading_progress_anchor is not None else 0,
-                convert_string_to_datetime(source['createdAt']),
-                convert_string_to_datetime(source['savedAt']),
-                convert_string_to_datetime(source.get('archivedAt', None)),
-                source.get('siteName', None),
-                subscription,
-                state,
-                updated_at,
-                convert_string_to_datetime(source.get('publishedAt', None)),
-                source.get('language', None),
-                convert_string_to_datetime(source.get('readAt', None)),
-                source.get('wordsCount', None),
-                source.get('siteIcon', None),
-                source.get('image', None),
-                content_reader,
-                original_html,
-                deleted_at,
-            )
-
-            library_items.append(library_item)
-            library_items_original_ids.append(doc_id)
-
-            # if user_id not in updated_user_ids:
-            #     updated_user_ids.append(user_id)
-
-            # convert labels to postgres format
-            if 'labels' in source:
-                for label in source['labels']:
-                    labels.append((
-                        get_uuid(label['id']),
-                        id,
-                        None,
-                    ))
-                    labels_original_ids.append(label['id'])
-
-            # convert highlights to postgres format
-            if 'highlights' in source:
-                for highlight in source['highlights']:
-                    highlight_id = get_uuid(highlight['id'])
-                    short_id = highlight.get('shortId', None)
-                    if len(short_id) > 14:
-                        short_id = short_id[:14]
-                    highlight_position_percent = highlight.get('highlightPositionPercent', 0)
-                    highlight_position_anchor_index = highlight.get('highlightPositionAnchorIndex', 0)
-
-                    highlights.append((
-                        highlight_id,
-                        get_uuid(highlight['userId']),
-                        highlight.get('quote', None),
-                        highlight.get('prefix', None),
-                        highlight.get('suffix', None),
-                        highlight.get('patch', None),
-                        highlight.get('annotation', None),
-                        convert_string_to_datetime(highlight['createdAt']),
-                        convert_string_to_datetime(highlight.get('updatedAt', None)),
-                        convert_string_to_datetime(highlight.get('sharedAt', None)),
-                        short_id,
-                        id,
-                        highlight_position_percent if highlight_position_percent is not None else 0,
-                        highlight_position_anchor_index if highlight_position_anchor_index is not None else 0,
-                        highlight.get('type', 'HIGHLIGHT'),
-                        highlight.get('color', None),
-                        highlight.get('html', None),
-                    ))
-                    highlights_original_ids.append(highlight['id'])
-
-                    if 'labels' in highlight:
-                        for label in highlight['labels']:
-                            labels.append((
-                                get_uuid(label['id']),
-                                None,
-                                highlight_id,
-                            ))
-                            labels_original_ids.append(label['id'])
-
-            # convert recommendations to postgres format
-            if 'recommendations' in source:
-                for recommendation in source['recommendations']:
-                    recommendations.append((
-                        id,
-                        get_uuid(recommendation['user']['userId']),
-                        get_uuid(recommendation['id']),
-                        recommendation.get('note', None),
-                        convert_string_to_datetime(recommendation['recommendedAt']),
-                    ))
-                    recommendations_original_ids.append(recommendation['id'])
-
-            # copy to postgres every ES_SCAN_SIZE records
-            if i % int(ES_SCAN_SIZE) == 0:
-                await insert_library_items(db_conn, library_items, library_items_original_ids)
-                print('Copied', i, 'records to postgres')
-                library_items = []
-                library_items_original_ids = []
-                if len(highlights) > 0:
-                    await insert_highlights(db_conn, highlights, highlights_original_ids)
-                    highlights = []
-                    highlights_original_ids = []
-                if len(labels) > 0:
-                    await insert_labels(db_conn, labels, labels_original_ids)
-                    labels = []
-                    labels_original_ids = []
-                if len(recommendations) > 0:
-                    await insert_recommendations(db_conn, recommendations, recommendations_original_ids)
-                    recommendations = []
-                    recommendations_original_ids = []
-
-        # copy remaining records to postgres
-        if len(library_items) > 0:
-            await insert_library_items(db_conn, library_items, library_items_original_ids)
-            print('Copied', i, 'records to postgres')
-        if len(highlights) > 0:
-            await insert_highlights(db_conn, highlights, highlights_original_ids)
-        if len(labels) > 0:
-            await insert_labels(db_conn, labels, labels_original_ids)
-        if len(recommendations) > 0:
-            await insert_recommendations(db_conn, recommendations, recommendations_original_ids)
+        if DRY_RUN:
+            await profile_migration(pool, es_client, users, uploaded_files)
+            return
+        if MODE == 'snapshot':
+            await write_snapshot(es_client, users, uploaded_files)
+            return
+        if MODE == 'verify':
+            await assert_data(pool, es_client, [user['id'] for user in users], uploaded_files)
+            return
+        if MODE == 'verify_content':
+            await verify_content(pool, es_client, [user['id'] for user in users], uploaded_files,
+                                 migration_time_range())
+            return
 
-        print('Migration complete', END_TIME)
+        if BULK_WINDOW:
+            window_open = True
+            await drop_indexes(pool, BULK_WINDOW_TABLES)
+        else:
+            # indexes left dropped by an interrupted bulk window come back first
+            await restore_indexes(pool)
+
+        budget = ByteBudget(int(MAX_INFLIGHT_BYTES))
+        throttle = AdaptiveThrottle(ES_SCAN_SIZE, PG_COOLDOWN_TIME)
+        progress = {'copied': sum(partition['copied'] for partition in checkpoint.state['partitions'].values())}
+        # the ETA covers the docs left after the ones a resumed run copied before
+        if MODE == 'replay':
+            total = load_manifest(SNAPSHOT_DIR)['docs']
+        else:
+            total = await count_docs(es_client, users, uploaded_files)
+        metrics.track_progress('docs_processed', max(total - progress['copied'], 0))
+        if MODE == 'replay':
+            await replay_snapshot(pool, executor, budget, throttle, checkpoint, progress)
+        elif WORK_QUEUE:
+            summary = await migrate_from_queue(pool, es_client, executor, throttle,
+                                               users, uploaded_files, progress)
+            if summary.get('pending', 0) + summary.get('running', 0) > 0:
+                # the rebuild is left to the process finishing the last unit
+                print('Work queue', WORK_QUEUE, 'still has units in progress, skipping the tsvector rebuild')
+                return
+        else:
+            # the time ranges are part of the checkpoint so a resumed run
+            # continues with the same partitions
+            if len(checkpoint.state['partitions']) == 0:
+                print('Splitting', START_TIME, END_TIME, 'into', ES_PARTITIONS, 'partitions')
+                time_ranges = await split_time_range(es_client, users, uploaded_files, int(ES_PARTITIONS))
+                for key, time_range in enumerate(time_ranges):
+                    checkpoint.partition(key)['range'] = time_range
+
+            print('Getting data from elastic and if uploadFileId exists, check if it exists in postgres')
+            await run_stages(*[
+                migrate_partition(pool, es_client, executor, budget, throttle, checkpoint, key,
+                                  build_query(users, uploaded_files, partition['range']), progress)
+                for key, partition in checkpoint.state['partitions'].items()
+            ])
 
-        # await assert_data(db_conn, es_client, updated_user_ids, uploaded_files)
+        if TSV_REBUILD:
+            # the rebuild looks up highlights by library item, their indexes go first
+            if window_open:
+                await restore_indexes(pool, ['highlight'])
+            await rebuild_tsvectors(pool)
+
+        print('Migration complete', END_TIME)
     except Exception as err:
         print('Migration error', err)
     finally:
+        if window_open:
+            try:
+                await restore_indexes(pool)
+            except Exception as err:
+                print('Restore indexes ERROR:', err)
+        metrics.stop()
         print('Closing connections')
-        # enable update_library_item_modtime trigger
-        await db_conn.execute('ALTER TABLE omnivore.library_item ENABLE TRIGGER update_library_item_modtime')
-        await db_conn.close()
+        await pool.close()
         await es_client.close()
+        if executor is not None:
+            executor.shutdown()
+
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main())
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
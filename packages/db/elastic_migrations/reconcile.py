@@ -0,0 +1,46 @@
+import os
+
+ES_COMPOSITE_SIZE = os.getenv('ES_COMPOSITE_SIZE', 1000)
+
+
+def composite_query(query, field, after_key=None, aggs=None):
+    # one page of a composite aggregation bucketing the docs by field
+    composite = {
+        'size': int(ES_COMPOSITE_SIZE),
+        'sources': [{field: {'terms': {'field': field}}}],
+    }
+    if after_key is not None:
+        composite['after'] = after_key
+    aggregation = {'composite': composite}
+    if aggs is not None:
+        aggregation['aggs'] = aggs
+    return {
+        'size': 0,
+        'query': query,
+        'aggs': {'buckets': aggregation},
+    }
+
+
+def composite_page(result):
+    # returns the buckets of the page and the key of the next page, None at the end
+    buckets = result['aggregations']['buckets']['buckets']
+    if len(buckets) == 0:
+        return buckets, None
+    return buckets, result['aggregations']['buckets'].get('after_key')
+
+
+def diff_counts(user_ids, postgres_counts, elastic_counts):
+    # compare the per user counts in memory, users missing on a side count as 0
+    success = 0
+    failure = 0
+    for user_id in user_ids:
+        user_id = str(user_id)
+        count_in_postgres = postgres_counts.get(user_id, 0)
+        count_in_elastic = elastic_counts.get(user_id, 0)
+        if count_in_postgres == count_in_elastic:
+            success += 1
+        else:
+            failure += 1
+            print(f'User {user_id} ERROR: postgres: {count_in_postgres}, elastic: {count_in_elastic}')
+    print(f'Asserted data, success: {success}, failure: {failure}')
+    return success, failure
@@ -0,0 +1,94 @@
+import json
+import os
+import time
+
+from migration_utils.checkpoint import load_checkpoint, save_checkpoint
+
+from export_sink import EXPORT_COMPRESSION, ExportSink, open_import
+
+# docs per NDJSON shard of a snapshot
+SNAPSHOT_SHARD_DOCS = os.getenv('SNAPSHOT_SHARD_DOCS', 100000)
+
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+EXTENSIONS = {'none': 'ndjson', 'gzip': 'ndjson.gz', 'zstd': 'ndjson.zst'}
+
+
+class SnapshotWriter:
+    """
+    Writes docs to a snapshot directory, NDJSON shards of one
+    {"_id": ..., "_source": {...}} doc per line, the same shape elastic
+    returns hits in. manifest.json lists the shards and doc counts and is
+    written last, a directory without it is an incomplete snapshot.
+    """
+
+    def __init__(self, directory, params, compression=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compression = EXPORT_COMPRESSION if compression is None else compression
+        self.manifest = {
+            'version': SNAPSHOT_VERSION,
+            'params': params,
+            'compression': self.compression,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'docs': 0,
+            'shards': [],
+        }
+        self.sink = None
+
+    def open_shard(self):
+        self.close_shard()
+        file = f'shard-{len(self.manifest["shards"]):05d}.{EXTENSIONS[self.compression]}'
+        self.sink = ExportSink(os.path.join(self.directory, file), self.compression)
+        self.manifest['shards'].append({'file': file, 'docs': 0})
+
+    def close_shard(self):
+        if self.sink is None:
+            return
+        shard = self.manifest['shards'][-1]
+        written = self.sink.close()
+        if self.sink.error is not None or written != shard['docs']:
+            raise Exception(f'Snapshot shard {shard["file"]} incomplete, wrote {written} of {shard["docs"]} docs')
+        self.sink = None
+
+    def write(self, docs):
+        start = 0
+        while start < len(docs):
+            if self.sink is None or self.manifest['shards'][-1]['docs'] >= int(SNAPSHOT_SHARD_DOCS):
+                self.open_shard()
+            shard = self.manifest['shards'][-1]
+            end = min(start + int(SNAPSHOT_SHARD_DOCS) - shard['docs'], len(docs))
+            self.sink.write([{'_id': doc['_id'], '_source': doc['_source']} for doc in docs[start:end]])
+            shard['docs'] += end - start
+            self.manifest['docs'] += end - start
+            start = end
+
+    def close(self):
+        self.close_shard()
+        save_checkpoint(os.path.join(self.directory, MANIFEST_FILE), self.manifest)
+        print(f'Wrote snapshot {self.directory}, {self.manifest["docs"]} docs in {len(self.manifest["shards"])} shards')
+        return self.manifest
+
+
+def load_manifest(directory):
+    manifest = load_checkpoint(os.path.join(directory, MANIFEST_FILE))
+    if manifest is None:
+        raise Exception(f'No {MANIFEST_FILE} in {directory}, the snapshot is missing or incomplete')
+    if manifest['version'] != SNAPSHOT_VERSION:
+        raise Exception(f'Snapshot {directory} has version {manifest["version"]}, expected {SNAPSHOT_VERSION}')
+    return manifest
+
+
+def read_snapshot(directory, skip=0):
+    # yields the docs in the order they were written, after the first skip
+    # docs so a replay can resume from the number of docs it copied
+    for shard in load_manifest(directory)['shards']:
+        if skip >= shard['docs']:
+            skip -= shard['docs']
+            continue
+        with open_import(os.path.join(directory, shard['file'])) as f:
+            for line in f:
+                if skip > 0:
+                    skip -= 1
+                    continue
+                yield json.loads(line)
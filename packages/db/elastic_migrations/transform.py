@@ -0,0 +1,180 @@
+from conversions import convert_string_to_datetime, get_cached_uuid, get_uuid
+
+
+def sanitize_tuples(tuples):
+    # most rows are clean, only rebuild the rows that have something to
+    # clean and replace them in place to avoid copying the whole batch
+    for i, row in enumerate(tuples):
+        for val in row:
+            if needs_sanitizing(val):
+                tuples[i] = tuple(sanitize_string(val) for val in row)
+                break
+    return tuples
+
+
+def needs_sanitizing(val):
+    # postgres text can't hold NUL bytes or lone surrogates
+    return isinstance(val, str) and ('\u0000' in val or has_surrogates(val))
+
+
+def has_surrogates(val):
+    # isascii is O(1) and covers most content, otherwise lone surrogates are
+    # the only thing utf-8 can't encode
+    if val.isascii():
+        return False
+    try:
+        val.encode('utf-8')
+        return False
+    except UnicodeEncodeError:
+        return True
+
+
+def sanitize_string(val):
+    # sanitize valu if val is a string
+    if not needs_sanitizing(val):
+        return val
+    val = val.replace('\u0000', '')
+    if has_surrogates(val):
+        val = val.encode('utf-8', 'replace').decode('utf-8')
+    return val
+
+
+def convert_docs(docs):
+    # convert a batch of elastic docs to postgres tuples, grouped by table.
+    # this is a pure function so it can run in a worker process
+    batch = {
+        'library_items': ([], []),
+        'highlights': ([], []),
+        'labels': ([], []),
+        'recommendations': ([], []),
+    }
+    library_items, library_items_original_ids = batch['library_items']
+    highlights, highlights_original_ids = batch['highlights']
+    labels, labels_original_ids = batch['labels']
+    recommendations, recommendations_original_ids = batch['recommendations']
+
+    for doc in docs:
+        # convert _id to uuid
+        doc_id = doc['_id']
+        id = get_uuid(doc_id)
+
+        # convert library items to postgres format
+        source = doc['_source']
+        subscription = source['subscription'] if 'subscription' in source else source.get('rssFeedUrl', None)
+        page_type = source['pageType']
+        content_reader = 'WEB'
+        if 'uploadFileId' in source:
+            if page_type == 'BOOK':
+                content_reader = 'EPUB'
+            elif page_type == 'FILE':
+                content_reader = 'PDF'
+        updated_at = convert_string_to_datetime(source['updatedAt'])
+        state = source['state']
+        deleted_at = updated_at if state == 'DELETED' else None
+        reading_progress_top_percent = source.get('readingProgressTopPercent', 0)
+        reading_progress_percent = source.get('readingProgressPercent', 0)
+        reading_progress_anchor = source.get('readingProgressAnchorIndex', 0)
+        content = source['content']
+        original_html = source.get('originalHtml', None)
+        description = source.get('description', None)
+        user_id = get_cached_uuid(source['userId'])
+
+        library_item = (
+            id,
+            user_id,
+            source['title'],
+            source.get('author', None),
+            description,
+            content,
+            source['url'],
+            source.get('uploadFileId', None),
+            page_type if page_type is not None else 'UNKNOWN',
+            source['slug'],
+            reading_progress_top_percent if reading_progress_top_percent is not None else 0,
+            reading_progress_percent if reading_progress_percent is not None else 0,
+            reading_progress_anchor if reading_progress_anchor is not None else 0,
+            convert_string_to_datetime(source['createdAt']),
+            convert_string_to_datetime(source['savedAt']),
+            convert_string_to_datetime(source.get('archivedAt', None)),
+            source.get('siteName', None),
+            subscription,
+            state,
+            updated_at,
+            convert_string_to_datetime(source.get('publishedAt', None)),
+            source.get('language', None),
+            convert_string_to_datetime(source.get('readAt', None)),
+            source.get('wordsCount', None),
+            source.get('siteIcon', None),
+            source.get('image', None),
+            content_reader,
+            original_html,
+            deleted_at,
+        )
+
+        library_items.append(library_item)
+        library_items_original_ids.append(doc_id)
+
+        # convert labels to postgres format
+        if 'labels' in source:
+            for label in source['labels']:
+                labels.append((
+                    get_cached_uuid(label['id']),
+                    id,
+                    None,
+                ))
+                labels_original_ids.append(label['id'])
+
+        # convert highlights to postgres format
+        if 'highlights' in source:
+            for highlight in source['highlights']:
+                highlight_id = get_uuid(highlight['id'])
+                short_id = highlight.get('shortId', None)
+                if len(short_id) > 14:
+                    short_id = short_id[:14]
+                highlight_position_percent = highlight.get('highlightPositionPercent', 0)
+                highlight_position_anchor_index = highlight.get('highlightPositionAnchorIndex', 0)
+
+                highlights.append((
+                    highlight_id,
+                    get_cached_uuid(highlight['userId']),
+                    highlight.get('quote', None),
+                    highlight.get('prefix', None),
+                    highlight.get('suffix', None),
+                    highlight.get('patch', None),
+                    highlight.get('annotation', None),
+                    convert_string_to_datetime(highlight['createdAt']),
+                    convert_string_to_datetime(highlight.get('updatedAt', None)),
+                    convert_string_to_datetime(highlight.get('sharedAt', None)),
+                    short_id,
+                    id,
+                    highlight_position_percent if highlight_position_percent is not None else 0,
+                    highlight_position_anchor_index if highlight_position_anchor_index is not None else 0,
+                    highlight.get('type', 'HIGHLIGHT'),
+                    highlight.get('color', None),
+                    highlight.get('html', None),
+                ))
+                highlights_original_ids.append(highlight['id'])
+
+                if 'labels' in highlight:
+                    for label in highlight['labels']:
+                        labels.append((
+                            get_cached_uuid(label['id']),
+                            None,
+                            highlight_id,
+                        ))
+                        labels_original_ids.append(label['id'])
+
+        # convert recommendations to postgres format
+        if 'recommendations' in source:
+            for recommendation in source['recommendations']:
+                recommendations.append((
+                    id,
+                    get_cached_uuid(recommendation['user']['userId']),
+                    get_cached_uuid(recommendation['id']),
+                    recommendation.get('note', None),
+                    convert_string_to_datetime(recommendation['recommendedAt']),
+                ))
+                recommendations_original_ids.append(recommendation['id'])
+
+    # sanitize here as well so it runs off the event loop
+    return {table: (sanitize_tuples(records), original_ids) for table, (records, original_ids) in batch.items()}
@@ -0,0 +1,160 @@
+import asyncio
+import os
+import time
+
+from migration_utils.metrics import metrics
+
+from digests import HEX_DIGITS, prefix_range
+
+# library items updated per statement and statements run in parallel
+TSV_BATCH_SIZE = os.getenv('TSV_BATCH_SIZE', 500)
+TSV_WORKERS = os.getenv('TSV_WORKERS', 4)
+# readable_content is cut to this many characters before it is converted,
+# a tsvector can't hold more than 1MB
+TSV_MAX_CONTENT_LENGTH = os.getenv('TSV_MAX_CONTENT_LENGTH', 500000)
+TSV_TIMEOUT = os.getenv('TSV_TIMEOUT', 600)
+
+# the rows loaded with omnivore.bulk_load skipped the tsvector trigger, with
+# session_replication_role = replica also the triggers of highlight,
+# entity_labels and recommendation. this recomputes what they maintain for
+# the rows without a search_tsv, the tsvectors as in update_library_item_tsv()
+# of migration 0143 and the denormalized names and annotations as in
+# migrations 0121, 0123 and 0129.
+# {operator} is >= for the first batch of a range and > after it, both bounds
+# stay plain comparisons the index scan can start from in a generic plan
+REBUILD_QUERY = r'''
+    WITH batch AS (
+        SELECT id
+        FROM omnivore.library_item
+        WHERE id {operator} $1 AND id <= $2 AND search_tsv IS NULL
+        ORDER BY id
+        LIMIT $3
+    ), derived AS (
+        SELECT
+            li.id,
+            COALESCE((
+                SELECT array_agg(coalesce(h.annotation, ''))
+                FROM omnivore.highlight h
+                WHERE h.library_item_id = li.id
+            ), array[]::text[]) AS highlight_annotations,
+            COALESCE((
+                SELECT array_agg(l.name)
+                FROM omnivore.labels l
+                INNER JOIN omnivore.entity_labels el ON el.label_id = l.id
+                WHERE el.library_item_id = li.id
+            ), array[]::text[]) AS label_names,
+            COALESCE((
+                SELECT array_agg(l.name)
+                FROM omnivore.labels l
+                INNER JOIN omnivore.entity_labels el ON el.label_id = l.id
+                INNER JOIN omnivore.highlight h ON h.id = el.highlight_id
+                WHERE h.library_item_id = li.id
+            ), array[]::text[]) AS highlight_labels,
+            COALESCE((
+                SELECT array_agg(DISTINCT names.name)
+                FROM omnivore.recommendation r,
+                LATERAL (
+                    SELECT name FROM omnivore.user WHERE id = r.recommender_id
+                    UNION
+                    SELECT name FROM omnivore.group WHERE id = r.group_id
+                ) names
+                WHERE r.library_item_id = li.id
+            ), array[]::text[]) AS recommender_names
+        FROM batch
+        INNER JOIN omnivore.library_item li ON li.id = batch.id
+    ), vectors AS (
+        SELECT
+            d.*,
+            to_tsvector('pg_catalog.english', coalesce(left(li.readable_content, $4), ''))
+                AS content_tsv,
+            to_tsvector('pg_catalog.english', coalesce(li.site_name, '')) ||
+                to_tsvector('pg_catalog.english', coalesce(regexp_replace(li.original_url, '^((http[s]?):\/)?\/?(.*\.)?(([^:\/\s]+)\.[^:\/\s]+)(.*)$', '\4'), '')) ||
+                to_tsvector('pg_catalog.english', coalesce(regexp_replace(li.original_url, '^((http[s]?):\/)?\/?(.*\.)?(([^:\/\s]+)\.[^:\/\s]+)(.*)$', '\5'), ''))
+                AS site_name_tsv,
+            to_tsvector('pg_catalog.english', coalesce(li.title, '')) AS title_tsv,
+            to_tsvector('pg_catalog.english', coalesce(li.author, '')) AS author_tsv,
+            to_tsvector('pg_catalog.english', coalesce(li.description, '')) AS description_tsv,
+            to_tsvector('pg_catalog.english', coalesce(li.note, '') || ' ' || array_to_string(d.highlight_annotations, ' '))
+                AS note_tsv
+        FROM derived d
+        INNER JOIN omnivore.library_item li ON li.id = d.id
+    ), updated AS (
+        UPDATE omnivore.library_item li SET
+            highlight_annotations = v.highlight_annotations,
+            label_names = v.label_names,
+            highlight_labels = v.highlight_labels,
+            recommender_names = v.recommender_names,
+            content_tsv = v.content_tsv,
+            site_name_tsv = v.site_name_tsv,
+            title_tsv = v.title_tsv,
+            author_tsv = v.author_tsv,
+            description_tsv = v.description_tsv,
+            note_tsv = v.note_tsv,
+            search_tsv =
+                setweight(v.title_tsv, 'A') ||
+                setweight(v.author_tsv, 'A') ||
+                setweight(v.site_name_tsv, 'A') ||
+                setweight(v.description_tsv, 'A') ||
+                setweight(v.note_tsv, 'A') ||
+                setweight(v.content_tsv, 'B')
+        FROM vectors v
+        WHERE li.id = v.id
+        RETURNING li.id
+    )
+    SELECT
+        (SELECT id FROM batch ORDER BY id DESC LIMIT 1) AS last_id,
+        (SELECT COUNT(*) FROM updated) AS rows_updated
+'''
+REBUILD_FIRST_QUERY = REBUILD_QUERY.replace('{operator}', '>=')
+REBUILD_NEXT_QUERY = REBUILD_QUERY.replace('{operator}', '>')
+
+
+async def rebuild_range(pool, prefix, progress):
+    # walk the ids starting with prefix in keyset order
+    after, high = prefix_range(prefix)
+    query = REBUILD_FIRST_QUERY
+    while True:
+        max_content_length = int(TSV_MAX_CONTENT_LENGTH)
+        while True:
+            try:
+                async with pool.acquire() as db_conn, db_conn.transaction():
+                    # keeps updated_at and skips the tsvector trigger
+                    # recomputing what this sets, migration 0191
+                    await db_conn.execute("SET LOCAL omnivore.bulk_load = 'on'")
+                    last_id, rows_updated = await db_conn.fetchrow(
+                        query, after, high, int(TSV_BATCH_SIZE), max_content_length,
+                        timeout=int(TSV_TIMEOUT))
+                break
+            except Exception as err:
+                # words of some content are too diverse for the limit, retry
+                # the batch with a shorter cut
+                if 'string is too long for tsvector' not in str(err) or max_content_length <= 1000:
+                    raise
+                max_content_length //= 10
+                metrics.inc('retries', table='library_item_tsv')
+                print(f'Rebuilding tsvectors after {after} with content cut to {max_content_length}:', err)
+        if last_id is None:
+            return
+        after = last_id
+        query = REBUILD_NEXT_QUERY
+        progress['rows'] += rows_updated
+        metrics.inc('tsv_rows_rebuilt', rows_updated)
+
+
+async def rebuild_tsvectors(pool):
+    # the uuid space is split by the first hex digit, TSV_WORKERS ranges at a time
+    print('Rebuilding tsvectors and derived columns of library items')
+    started_at = time.time()
+    progress = {'rows': 0}
+    prefixes = asyncio.Queue()
+    for digit in HEX_DIGITS:
+        prefixes.put_nowait(digit)
+
+    async def worker():
+        while not prefixes.empty():
+            prefix = prefixes.get_nowait()
+            await rebuild_range(pool, prefix, progress)
+            print(f'Rebuilt tsvectors of range {prefix}, {progress["rows"]} rows so far')
+
+    await asyncio.gather(*[worker() for _ in range(int(TSV_WORKERS))])
+    print(f'Rebuilt tsvectors of {progress["rows"]} library items in {time.time() - started_at:.1f}s')
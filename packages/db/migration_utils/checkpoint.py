@@ -0,0 +1,74 @@
+import json
+import os
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, state):
+    # write to a temp file and rename it so a crash never leaves a torn file
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """
+    Persists the sort position of the last committed batch per partition.
+
+    Batches are committed by concurrent writers in any order, the position
+    only moves forward once every earlier batch of the partition is committed.
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.state = {'params': params, 'partitions': {}}
+        self.next_sequence = {}
+        self.committed = {}
+
+    def resume(self):
+        state = load_checkpoint(self.path)
+        if state is None:
+            print('No checkpoint found at', self.path)
+            return
+        if state.get('params') != self.params:
+            raise Exception(f'Checkpoint {self.path} was written for {state.get("params")}, not {self.params}')
+        self.state = state
+        print('Resuming from checkpoint', self.path)
+
+    def partition(self, key):
+        return self.state['partitions'].setdefault(str(key), {
+            'search_after': None,
+            'copied': 0,
+            'done': False,
+        })
+
+    def commit(self, key, sequence, search_after, copied):
+        key = str(key)
+        committed = self.committed.setdefault(key, {})
+        committed[sequence] = (search_after, copied)
+
+        partition = self.partition(key)
+        next_sequence = self.next_sequence.get(key, 0)
+        while next_sequence in committed:
+            search_after, copied = committed.pop(next_sequence)
+            if search_after is not None:
+                partition['search_after'] = search_after
+            partition['copied'] += copied
+            next_sequence += 1
+
+        if self.next_sequence.get(key, 0) != next_sequence:
+            self.next_sequence[key] = next_sequence
+            save_checkpoint(self.path, self.state)
+
+    def finish(self, key):
+        self.partition(key)['done'] = True
+        save_checkpoint(self.path, self.state)
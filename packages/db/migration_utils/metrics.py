@@ -0,0 +1,155 @@
+import json
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# port of the prometheus text endpoint, 0 disables it. it only listens on
+# the loopback interface unless METRICS_HOST says otherwise
+METRICS_PORT = os.getenv('METRICS_PORT', 0)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# seconds between two JSON metrics log lines, 0 disables them
+METRICS_LOG_INTERVAL = os.getenv('METRICS_LOG_INTERVAL', 30)
+
+METRICS_PREFIX = 'omnivore_migration_'
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def format_bound(bound):
+    return '+Inf' if bound == math.inf else str(bound)
+
+
+class Metrics:
+    """
+    Counters and latency histograms shared by the threads and stages of a
+    script. They are served in the prometheus text format on METRICS_PORT
+    and logged as a JSON line every METRICS_LOG_INTERVAL seconds, with the
+    rate and ETA of the counter set by track_progress.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.script = None
+        self.started_at = time.time()
+        self.progress_counter = None
+        self.progress_total = None
+        self.stopped = threading.Event()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.setdefault(label_key(labels), {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0, 'count': 0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def track_progress(self, counter, total):
+        # the ETA is the remaining part of total at the average rate of counter
+        self.progress_counter = counter
+        self.progress_total = total
+
+    def total(self, name):
+        with self.lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {METRICS_PREFIX}{name}_total counter')
+                for key, value in series.items():
+                    lines.append(f'{METRICS_PREFIX}{name}_total{format_labels(key)} {value}')
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {METRICS_PREFIX}{name}_seconds histogram')
+                for key, histogram in series.items():
+                    for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                        lines.append(f'{METRICS_PREFIX}{name}_seconds_bucket{format_labels(key, le=format_bound(bound))} {count}')
+                    lines.append(f'{METRICS_PREFIX}{name}_seconds_sum{format_labels(key)} {histogram["sum"]}')
+                    lines.append(f'{METRICS_PREFIX}{name}_seconds_count{format_labels(key)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        with self.lock:
+            counters = {name + format_labels(key): value
+                        for name, series in self.counters.items() for key, value in series.items()}
+            latencies = {name + format_labels(key): {
+                'count': histogram['count'],
+                'avg_seconds': round(histogram['sum'] / histogram['count'], 4) if histogram['count'] else 0,
+            } for name, series in self.histograms.items() for key, histogram in series.items()}
+        line = {
+            'script': self.script,
+            'elapsed_seconds': round(elapsed, 1),
+            'counters': counters,
+            'rates': {name: round(value / elapsed, 1) for name, value in counters.items()},
+            'latencies': latencies,
+        }
+        if self.progress_counter is not None:
+            done = self.total(self.progress_counter)
+            rate = done / elapsed
+            line['progress'] = {'counter': self.progress_counter, 'done': done, 'total': self.progress_total}
+            if self.progress_total and rate > 0:
+                line['eta_seconds'] = round(max(self.progress_total - done, 0) / rate)
+        return line
+
+    def log(self):
+        print(json.dumps({'metrics': self.summary()}))
+
+    def start(self, script):
+        self.script = script
+        self.started_at = time.time()
+        if int(METRICS_PORT) > 0:
+            server = ThreadingHTTPServer((METRICS_HOST, int(METRICS_PORT)), MetricsHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            print(f'Serving metrics on {METRICS_HOST}:{METRICS_PORT}')
+        if float(METRICS_LOG_INTERVAL) > 0:
+            threading.Thread(target=self.log_periodically, daemon=True).start()
+
+    def log_periodically(self):
+        while not self.stopped.wait(float(METRICS_LOG_INTERVAL)):
+            self.log()
+
+    def stop(self):
+        self.stopped.set()
+        self.log()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep the scrapes out of the migration output
+        pass
+
+
+# one registry per process, shared by the modules of a script
+metrics = Metrics()
@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+
+# shared by the db scripts: --dry-run never writes and only prints the plans
+# and estimated row counts, --dry-run --profile also runs EXPLAIN ANALYZE on a
+# representative batch inside a rolled back transaction and projects the totals
+DRY_RUN = os.getenv('DRY_RUN', 'false') == 'true' or '--dry-run' in sys.argv
+PROFILE = os.getenv('PROFILE', 'false') == 'true' or '--profile' in sys.argv
+PROFILE_SAMPLE_SIZE = os.getenv('PROFILE_SAMPLE_SIZE', 100)
+
+BLOCK_SIZE = 8192
+
+
+def explain_query(sql, analyze):
+    if analyze:
+        return f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}'
+    return f'EXPLAIN (FORMAT JSON) {sql}'
+
+
+def summarize_plan(plan):
+    # plan is the EXPLAIN (FORMAT JSON) output, a string with asyncpg
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]
+    node = plan['Plan']
+    # a ModifyTable node reports no rows, its input has the rows it touches
+    rows_node = node['Plans'][0] if node['Node Type'] == 'ModifyTable' and 'Plans' in node else node
+    return {
+        'rows': rows_node.get('Actual Rows', rows_node['Plan Rows']),
+        'cost': node['Total Cost'],
+        'time_ms': plan.get('Execution Time', 0) + plan.get('Planning Time', 0),
+        'read_bytes': node.get('Shared Read Blocks', 0) * BLOCK_SIZE,
+        'hit_bytes': node.get('Shared Hit Blocks', 0) * BLOCK_SIZE,
+        'written_bytes': (node.get('Shared Dirtied Blocks', 0) + node.get('Shared Written Blocks', 0)) * BLOCK_SIZE,
+    }
+
+
+def explain(conn, sql, params=None, analyze=False):
+    # psycopg2, the statement is always rolled back
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(explain_query(sql, analyze), params)
+            return summarize_plan(cursor.fetchone()[0])
+    finally:
+        conn.rollback()
+
+
+async def explain_async(db_conn, sql, args=(), analyze=False):
+    # asyncpg, the caller runs it inside a transaction it rolls back
+    return summarize_plan(await db_conn.fetchval(explain_query(sql, analyze), *args))
+
+
+def merge_summaries(summaries):
+    total = {'rows': 0, 'cost': 0, 'time_ms': 0, 'read_bytes': 0, 'hit_bytes': 0, 'written_bytes': 0}
+    for summary in summaries:
+        for key in total:
+            total[key] += summary[key]
+    return total
+
+
+def print_plan(name, summary):
+    print(f'[dry-run] {name}: estimated rows {summary["rows"]}, cost {summary["cost"]}')
+
+
+def print_projection(name, sample, sample_rows, total_rows):
+    # scale the measured batch linearly up to the whole data set
+    if sample_rows == 0:
+        print(f'[profile] {name}: no rows sampled, nothing to project')
+        return
+    factor = total_rows / sample_rows
+    print(f'[profile] {name}: sampled {sample_rows} rows in {sample["time_ms"]:.1f} ms, '
+          f'read {sample["read_bytes"]} bytes, hit {sample["hit_bytes"]} bytes, '
+          f'wrote {sample["written_bytes"]} bytes')
+    print(f'[profile] {name}: projected for {total_rows} rows: '
+          f'{sample["time_ms"] * factor / 1000:.1f} s, '
+          f'read {int(sample["read_bytes"] * factor)} bytes, '
+          f'wrote {int(sample["written_bytes"] * factor)} bytes')
@@ -0,0 +1,73 @@
+import os
+import time
+
+# shared by the db maintenance scripts, THROTTLE=false keeps batch size and pause fixed
+THROTTLE = os.getenv('THROTTLE', 'true') == 'true'
+# seconds a batch should take, batches grow while below and shrink above it
+THROTTLE_TARGET_LATENCY = os.getenv('THROTTLE_TARGET_LATENCY', 1)
+# replication lag in bytes of WAL and backends waiting on locks tolerated
+THROTTLE_MAX_LAG_BYTES = os.getenv('THROTTLE_MAX_LAG_BYTES', 64 * 1024 * 1024)
+THROTTLE_MAX_LOCK_WAITS = os.getenv('THROTTLE_MAX_LOCK_WAITS', 2)
+THROTTLE_MIN_BATCH = os.getenv('THROTTLE_MIN_BATCH', 10)
+THROTTLE_MAX_BATCH = os.getenv('THROTTLE_MAX_BATCH', 10000)
+THROTTLE_MIN_PAUSE = os.getenv('THROTTLE_MIN_PAUSE', 0)
+THROTTLE_MAX_PAUSE = os.getenv('THROTTLE_MAX_PAUSE', 30)
+# seconds between two reads of the replication and lock stats
+THROTTLE_HEALTH_INTERVAL = os.getenv('THROTTLE_HEALTH_INTERVAL', 5)
+
+# replica lag needs the pg_monitor role, without it the lag reads as 0
+HEALTH_QUERY = '''
+    SELECT
+        (SELECT COALESCE(MAX(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)), 0)::bigint
+         FROM pg_stat_replication) AS lag_bytes,
+        (SELECT COUNT(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock') AS lock_waits
+'''
+
+
+class AdaptiveThrottle:
+    """
+    AIMD rate controller for batched writes against a live primary.
+
+    While batches finish under the target latency and the replicas and lock
+    queues are healthy the batch size grows additively and the pause shrinks,
+    on any sign of pressure the batch size is halved and the pause doubled.
+    """
+
+    def __init__(self, batch_size, pause=0):
+        self.enabled = THROTTLE
+        self.batch_size = int(batch_size)
+        self.pause = float(pause)
+        self.min_batch_size = min(int(THROTTLE_MIN_BATCH), self.batch_size)
+        self.max_batch_size = max(int(THROTTLE_MAX_BATCH), self.batch_size)
+        self.step = max(self.batch_size // 10, 1)
+        self.lag_bytes = 0
+        self.lock_waits = 0
+        self.checked_at = 0
+
+    def health_due(self):
+        return self.enabled and time.time() - self.checked_at >= float(THROTTLE_HEALTH_INTERVAL)
+
+    def update_health(self, lag_bytes, lock_waits):
+        self.lag_bytes = lag_bytes or 0
+        self.lock_waits = lock_waits or 0
+        self.checked_at = time.time()
+
+    def record(self, latency):
+        if not self.enabled:
+            return
+        congested = (latency > float(THROTTLE_TARGET_LATENCY)
+                     or self.lag_bytes > int(THROTTLE_MAX_LAG_BYTES)
+                     or self.lock_waits > int(THROTTLE_MAX_LOCK_WAITS))
+        if congested:
+            self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+            self.pause = min(max(self.pause * 2, 0.1), float(THROTTLE_MAX_PAUSE))
+            print(f'Throttling down: batch size {self.batch_size}, pause {self.pause:.2f}s, '
+                  f'latency {latency:.2f}s, lag {self.lag_bytes} bytes, lock waits {self.lock_waits}')
+        else:
+            self.batch_size = min(self.batch_size + self.step, self.max_batch_size)
+            self.pause = self.pause / 2 if self.pause > 0.1 else 0
+            self.pause = max(self.pause, float(THROTTLE_MIN_PAUSE))
+
+    def wait(self):
+        if self.pause > 0:
+            time.sleep(self.pause)
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+import re
+import socket
+import time
+import uuid
+
+# seconds a claimed unit stays leased without a heartbeat before another
+# worker may take it over
+WORK_LEASE_SECONDS = os.getenv('WORK_LEASE_SECONDS', 300)
+# a unit failing this many times is parked as failed instead of retried
+WORK_MAX_ATTEMPTS = os.getenv('WORK_MAX_ATTEMPTS', 3)
+WORK_ENQUEUE_BATCH = 10000
+
+# omnivore.migration_work_unit (migration 0190) is shared by all queues, a
+# queue is the set of units with the same name. queries use %s placeholders,
+# numbered() turns them into asyncpg's $n
+ENQUEUE_QUERY = '''
+    INSERT INTO omnivore.migration_work_unit (queue, unit_key, payload)
+    SELECT %s, u.unit_key, u.payload::jsonb
+    FROM unnest(%s::text[], %s::text[]) AS u(unit_key, payload)
+    ON CONFLICT (queue, unit_key) DO NOTHING
+'''
+
+# a unit whose worker died on its last attempt can't be claimed again, it is
+# parked as failed once its lease runs out instead of staying running
+SWEEP_QUERY = '''
+    UPDATE omnivore.migration_work_unit SET
+        status = 'failed',
+        lease_expires_at = NULL,
+        last_error = coalesce(last_error, 'lease expired on the last attempt'),
+        updated_at = current_timestamp
+    WHERE queue = %s AND status = 'running' AND lease_expires_at < current_timestamp AND attempts >= %s
+'''
+
+# pending units and units whose lease ran out, fewest attempts first, the
+# rows other workers are claiming right now are skipped instead of waited on
+CLAIM_QUERY = '''
+    UPDATE omnivore.migration_work_unit w SET
+        status = 'running',
+        attempts = w.attempts + 1,
+        leased_by = %s,
+        lease_expires_at = current_timestamp + %s::integer * interval '1 second',
+        updated_at = current_timestamp
+    FROM (
+        SELECT queue, unit_key
+        FROM omnivore.migration_work_unit
+        WHERE queue = %s AND attempts < %s
+            AND (status = 'pending' OR (status = 'running' AND lease_expires_at < current_timestamp))
+        ORDER BY attempts, unit_key
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) c
+    WHERE w.queue = c.queue AND w.unit_key = c.unit_key
+    RETURNING w.unit_key, w.payload::text, w.attempts
+'''
+
+EXTEND_QUERY = '''
+    UPDATE omnivore.migration_work_unit SET
+        lease_expires_at = current_timestamp + %s::integer * interval '1 second',
+        updated_at = current_timestamp
+    WHERE queue = %s AND unit_key = %s AND leased_by = %s AND status = 'running'
+    RETURNING unit_key
+'''
+
+COMPLETE_QUERY = '''
+    UPDATE omnivore.migration_work_unit SET
+        status = 'done',
+        lease_expires_at = NULL,
+        last_error = NULL,
+        updated_at = current_timestamp
+    WHERE queue = %s AND unit_key = %s AND leased_by = %s
+'''
+
+FAIL_QUERY = '''
+    UPDATE omnivore.migration_work_unit SET
+        status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+        lease_expires_at = NULL,
+        last_error = %s,
+        updated_at = current_timestamp
+    WHERE queue = %s AND unit_key = %s AND leased_by = %s
+'''
+
+# only units with a live lease count as running, the others are claimable again
+SUMMARY_QUERY = '''
+    SELECT
+        CASE WHEN status = 'running' AND lease_expires_at < current_timestamp THEN 'pending' ELSE status END,
+        COUNT(*)
+    FROM omnivore.migration_work_unit
+    WHERE queue = %s
+    GROUP BY 1
+'''
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+def numbered(sql):
+    counter = iter(range(1, sql.count('%s') + 1))
+    return re.sub('%s', lambda _: f'${next(counter)}', sql)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def enqueue_args(units):
+    # units are (key, payload) pairs, payloads are stored as jsonb
+    keys = [str(key) for key, _ in units]
+    payloads = [json.dumps(payload, default=str) for _, payload in units]
+    return keys, payloads
+
+
+class WorkQueue:
+    """
+    Queue of work units in postgres claimed with FOR UPDATE SKIP LOCKED, so
+    any number of processes on any number of hosts can share it. A claim is
+    a lease that runs out unless the worker calls heartbeat, then the unit
+    is handed to another worker. Failed units are retried up to
+    WORK_MAX_ATTEMPTS times. Units have to be idempotent.
+
+    This one runs on a psycopg2 connection, AsyncWorkQueue on asyncpg.
+    """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.worker = worker_name()
+        self.extended_at = {}
+
+    def execute(self, query, params):
+        with self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchall() if cursor.description is not None else None
+        self.conn.commit()
+        return rows
+
+    def enqueue(self, units):
+        for start in range(0, len(units), WORK_ENQUEUE_BATCH):
+            self.execute(ENQUEUE_QUERY, (self.name, *enqueue_args(units[start:start + WORK_ENQUEUE_BATCH])))
+
+    def sweep(self):
+        self.execute(SWEEP_QUERY, (self.name, int(WORK_MAX_ATTEMPTS)))
+
+    def claim(self):
+        # returns (key, payload, attempts) or None once nothing is left to claim
+        self.sweep()
+        rows = self.execute(CLAIM_QUERY, (self.worker, int(WORK_LEASE_SECONDS), self.name, int(WORK_MAX_ATTEMPTS)))
+        if len(rows) == 0:
+            return None
+        key, payload, attempts = rows[0]
+        self.extended_at[key] = time.time()
+        return key, json.loads(payload), attempts
+
+    def heartbeat(self, key):
+        # extends the lease once a third of it has passed, raises
+        # LeaseLostError once another worker may have taken the unit over
+        if time.time() - self.extended_at.get(key, 0) < int(WORK_LEASE_SECONDS) / 3:
+            return
+        self.extended_at[key] = time.time()
+        if len(self.execute(EXTEND_QUERY, (int(WORK_LEASE_SECONDS), self.name, key, self.worker))) == 0:
+            self.extended_at.pop(key, None)
+            raise LeaseLostError(f'Lost the lease of work unit {key}')
+
+    def complete(self, key):
+        self.extended_at.pop(key, None)
+        self.execute(COMPLETE_QUERY, (self.name, key, self.worker))
+
+    def fail(self, key, err):
+        self.extended_at.pop(key, None)
+        self.execute(FAIL_QUERY, (int(WORK_MAX_ATTEMPTS), str(err), self.name, key, self.worker))
+
+    def summary(self):
+        self.sweep()
+        return dict(self.execute(SUMMARY_QUERY, (self.name,)))
+
+
+class AsyncWorkQueue:
+    """
+    WorkQueue on an asyncpg pool, hold() keeps the lease of a unit while
+    its task runs and cancels the task once the lease is lost.
+    """
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self.worker = worker_name()
+
+    async def enqueue(self, units):
+        for start in range(0, len(units), WORK_ENQUEUE_BATCH):
+            await self.pool.execute(numbered(ENQUEUE_QUERY), self.name,
+                                    *enqueue_args(units[start:start + WORK_ENQUEUE_BATCH]))
+
+    async def sweep(self):
+        await self.pool.execute(numbered(SWEEP_QUERY), self.name, int(WORK_MAX_ATTEMPTS))
+
+    async def claim(self):
+        await self.sweep()
+        row = await self.pool.fetchrow(numbered(CLAIM_QUERY), self.worker, int(WORK_LEASE_SECONDS),
+                                       self.name, int(WORK_MAX_ATTEMPTS))
+        if row is None:
+            return None
+        key, payload, attempts = row
+        return key, json.loads(payload), attempts
+
+    async def hold(self, key, task):
+        # run as a task next to the unit's task, cancel it when done. returns
+        # after cancelling the unit's task when the lease is lost, so two
+        # workers never load the same unit
+        while True:
+            await asyncio.sleep(int(WORK_LEASE_SECONDS) / 3)
+            extended = await self.pool.fetchval(numbered(EXTEND_QUERY), int(WORK_LEASE_SECONDS),
+                                                self.name, key, self.worker)
+            if extended is None:
+                print('Lost the lease of work unit', key)
+                task.cancel()
+                return
+
+    async def complete(self, key):
+        await self.pool.execute(numbered(COMPLETE_QUERY), self.name, key, self.worker)
+
+    async def fail(self, key, err):
+        await self.pool.execute(numbered(FAIL_QUERY), int(WORK_MAX_ATTEMPTS), str(err), self.name, key, self.worker)
+
+    async def summary(self):
+        await self.sweep()
+        return {status: count for status, count in await self.pool.fetch(numbered(SUMMARY_QUERY), self.name)}
@@ -0,0 +1,22 @@
+-- Type: DO
+-- Name: migration_work_unit
+-- Description: Create a table of work units shared by the processes of a data migration
+
+BEGIN;
+
+CREATE TABLE omnivore.migration_work_unit (
+    queue TEXT NOT NULL,
+    unit_key TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    leased_by TEXT,
+    lease_expires_at TIMESTAMPTZ,
+    last_error TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (queue, unit_key)
+);
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON omnivore.migration_work_unit TO omnivore_user;
+
+COMMIT;
@@ -0,0 +1,9 @@
+-- Type: UNDO
+-- Name: migration_work_unit
+-- Description: Create a table of work units shared by the processes of a data migration
+
+BEGIN;
+
+DROP TABLE IF EXISTS omnivore.migration_work_unit;
+
+COMMIT;
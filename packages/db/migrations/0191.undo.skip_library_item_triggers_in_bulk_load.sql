@@ -0,0 +1,23 @@
+-- Type: UNDO
+-- Name: skip_library_item_triggers_in_bulk_load
+-- Description: Skip the modtime and tsvector triggers of omnivore.library_item in transactions that set omnivore.bulk_load
+
+BEGIN;
+
+DROP TRIGGER IF EXISTS update_library_item_modtime ON omnivore.library_item;
+
+CREATE TRIGGER update_library_item_modtime
+    BEFORE UPDATE
+    ON omnivore.library_item
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_updated_at_column();
+
+DROP TRIGGER IF EXISTS library_item_tsv_update ON omnivore.library_item;
+
+CREATE TRIGGER library_item_tsv_update
+    BEFORE INSERT OR UPDATE OF readable_content, site_name, title, author, description, note, highlight_annotations
+    ON omnivore.library_item
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_library_item_tsv();
+
+COMMIT;
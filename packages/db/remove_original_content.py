@@ -1,51 +1,331 @@
 #!/usr/bin/python3
 import os
+import sys
+import threading
+import time
+import uuid
 
 import psycopg2
 
+from migration_utils.checkpoint import load_checkpoint, save_checkpoint
+from migration_utils.metrics import metrics
+from migration_utils.profiling import DRY_RUN, PROFILE, explain, print_plan, print_projection
+from migration_utils.throttle import HEALTH_QUERY, AdaptiveThrottle
+from migration_utils.work_queue import LeaseLostError, WorkQueue
+
 PG_HOST = os.getenv('PG_HOST', 'localhost')
 PG_PORT = os.getenv('PG_PORT', 5432)
 PG_USER = os.getenv('PG_USER', 'app_user')
 PG_PASSWORD = os.getenv('PG_PASSWORD', 'app_pass')
 PG_DB = os.getenv('PG_DB', 'omnivore')
 PG_TIMEOUT = os.getenv('PG_TIMEOUT', 10)
+# initial batch size, adapted to the load of the database unless THROTTLE=false
 BATCH_SIZE = os.getenv('BATCH_SIZE', 100)
+# number of disjoint id ranges updated in parallel, one connection each
+WORKERS = os.getenv('WORKERS', 1)
+CURSOR_FILE = os.getenv('CURSOR_FILE', 'remove_original_content.cursor.json')
+# resume from the positions in CURSOR_FILE
+RESUME = os.getenv('RESUME', 'false') == 'true' or '--resume' in sys.argv
+PROGRESS_INTERVAL = os.getenv('PROGRESS_INTERVAL', 10)
+# run VACUUM (ANALYZE) on library_item every VACUUM_EVERY batches, 0 disables it
+VACUUM_EVERY = os.getenv('VACUUM_EVERY', 0)
+# vacuum once more after the last batch before measuring the result
+FINAL_VACUUM = os.getenv('FINAL_VACUUM', 'false') == 'true'
+# name of a shared postgres work queue of id ranges, so several processes
+# on several hosts can split the table, empty splits it in WORKERS ranges
+WORK_QUEUE = os.getenv('WORK_QUEUE', '')
+# id ranges the table is split in for the work queue
+WORK_UNITS = os.getenv('WORK_UNITS', 256)
+# percent of the table sampled to estimate the size of original_content
+SAMPLE_PERCENT = os.getenv('SAMPLE_PERCENT', 1)
+
+# walk library_item by primary key, every batch starts where the last one
+# ended instead of searching the table again for rows to update
+BATCH_QUERY = '''
+    WITH batch AS (
+        SELECT id, pg_column_size(original_content) AS bytes
+        FROM omnivore.library_item
+        WHERE id >= %(lower)s AND id <= %(upper)s AND (%(first)s OR id > %(after)s)
+        ORDER BY id
+        LIMIT %(limit)s
+    ), updated AS (
+        UPDATE omnivore.library_item l
+        SET original_content = NULL
+        FROM batch
+        WHERE l.id = batch.id AND l.original_content IS NOT NULL
+        RETURNING batch.bytes
+    )
+    SELECT
+        (SELECT id FROM batch ORDER BY id DESC LIMIT 1) AS last_id,
+        (SELECT COUNT(*) FROM updated) AS rows_updated,
+        (SELECT COALESCE(SUM(bytes), 0) FROM updated) AS bytes_freed
+'''
+
+
+TABLE_SIZE_QUERY = '''
+    SELECT
+        pg_relation_size(c.oid) AS heap_bytes,
+        COALESCE(pg_total_relation_size(NULLIF(c.reltoastrelid, 0)), 0) AS toast_bytes,
+        s.n_live_tup AS live_tuples,
+        s.n_dead_tup AS dead_tuples
+    FROM pg_class c
+    INNER JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.oid = 'omnivore.library_item'::regclass
+'''
+
+SAMPLE_QUERY = '''
+    SELECT COALESCE(SUM(pg_column_size(original_content)), 0)
+    FROM omnivore.library_item TABLESAMPLE SYSTEM (%(percent)s)
+'''
+
+REMAINING_QUERY = '''
+    SELECT id FROM omnivore.library_item WHERE original_content IS NOT NULL
+'''
+
+
+def connect():
+    return psycopg2.connect(
+        f'host={PG_HOST} port={PG_PORT} dbname={PG_DB} user={PG_USER} \
+        password={PG_PASSWORD} connect_timeout={PG_TIMEOUT}')
+
 
+def split_id_ranges(workers):
+    # split the uuid space in equal, disjoint ranges
+    size = (1 << 128) // workers
+    ranges = []
+    for i in range(workers):
+        upper = (1 << 128) - 1 if i == workers - 1 else (i + 1) * size - 1
+        ranges.append({
+            'lower': str(uuid.UUID(int=i * size)),
+            'upper': str(uuid.UUID(int=upper)),
+            'after': None,
+            'done': False,
+        })
+    return ranges
 
-def batch_update_library_items(conn):
+
+def batch_update_library_items(conn, id_range, progress, queue=None, key=None):
+    throttle = AdaptiveThrottle(BATCH_SIZE)
     # update original_content to NULL in batches
     with conn.cursor() as cursor:
-        while True:
-            cursor.execute(f"""
-                UPDATE omnivore.library_item
-                SET original_content = NULL
-                WHERE id IN (
-                    SELECT id
-                    FROM omnivore.library_item
-                    WHERE original_content IS NOT NULL
-                    ORDER BY user_id
-                    LIMIT {BATCH_SIZE}
-                )
-            """)
+        while not id_range['done']:
+            started_at = time.time()
+            cursor.execute(BATCH_QUERY, {
+                'lower': id_range['lower'],
+                'upper': id_range['upper'],
+                'first': id_range['after'] is None,
+                'after': id_range['after'],
+                'limit': throttle.batch_size,
+            })
+            last_id, rows_updated, bytes_freed = cursor.fetchone()
             conn.commit()
 
-            rows_updated = cursor.rowcount
-            if rows_updated == 0:
-                break
+            if throttle.health_due():
+                cursor.execute(HEALTH_QUERY)
+                throttle.update_health(*cursor.fetchone())
+                conn.commit()
+            throttle.record(time.time() - started_at)
+            metrics.observe('batch', time.time() - started_at)
+            metrics.inc('rows_updated', rows_updated)
+            metrics.inc('bytes_freed', bytes_freed)
+
+            with progress['lock']:
+                if last_id is None:
+                    id_range['done'] = True
+                else:
+                    id_range['after'] = str(last_id)
+                progress['rows'] += rows_updated
+                progress['bytes'] += bytes_freed
+                progress['batches'] += 1
+                if progress['state'] is not None:
+                    save_checkpoint(CURSOR_FILE, progress['state'])
+
+            if queue is not None:
+                queue.heartbeat(key)
+            throttle.wait()
+
+
+def run_worker(id_range, progress):
+    try:
+        conn = connect()
+        try:
+            batch_update_library_items(conn, id_range, progress)
+        finally:
+            conn.close()
+    except Exception as err:
+        print('Worker error', id_range['lower'], err)
+        progress['errors'].append(err)
+
+
+def run_queue_worker(progress):
+    # claim id ranges until the shared queue is empty, a retried range starts
+    # over, the rows already cleared are skipped by the update
+    try:
+        conn = connect()
+        try:
+            queue = WorkQueue(conn, WORK_QUEUE)
+            while True:
+                unit = queue.claim()
+                if unit is None:
+                    return
+                key, id_range, attempts = unit
+                try:
+                    batch_update_library_items(conn, id_range, progress, queue, key)
+                    queue.complete(key)
+                except LeaseLostError as err:
+                    # another worker may have the range by now, leave it to them
+                    print(err)
+                except Exception as err:
+                    conn.rollback()
+                    print('Work unit', key, 'attempt', attempts, 'ERROR:', err)
+                    queue.fail(key, err)
+                    metrics.inc('retries')
+        finally:
+            conn.close()
+    except Exception as err:
+        print('Worker error', err)
+        progress['errors'].append(err)
+
+
+def report_progress(progress, started_at):
+    elapsed = max(time.time() - started_at, 1e-6)
+    with progress['lock']:
+        rows, bytes_freed = progress['rows'], progress['bytes']
+    ranges = ''
+    if progress['state'] is not None:
+        done = sum(1 for id_range in progress['state']['ranges'] if id_range['done'])
+        ranges = f', {done}/{len(progress["state"]["ranges"])} ranges done'
+    print(f'Updated {rows} rows, freed {bytes_freed} bytes, '
+          f'{rows / elapsed:.1f} rows/s, {bytes_freed / elapsed:.1f} bytes/s{ranges}')
+
+
+def table_sizes(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(TABLE_SIZE_QUERY)
+        heap_bytes, toast_bytes, live_tuples, dead_tuples = cursor.fetchone()
+        cursor.execute(SAMPLE_QUERY, {'percent': float(SAMPLE_PERCENT)})
+        sampled_bytes, = cursor.fetchone()
+    return {
+        'heap_bytes': heap_bytes,
+        'toast_bytes': toast_bytes,
+        'live_tuples': live_tuples,
+        'dead_tuples': dead_tuples,
+        'original_content_bytes': int(sampled_bytes * 100 / float(SAMPLE_PERCENT)),
+    }
+
+
+def vacuum_library_item(conn):
+    print('Vacuuming omnivore.library_item')
+    started_at = time.time()
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM (ANALYZE) omnivore.library_item')
+    print(f'Vacuumed omnivore.library_item in {time.time() - started_at:.1f}s')
+    metrics.observe('vacuum', time.time() - started_at)
+
+
+def print_summary(before, after, progress):
+    print('Space reclamation summary')
+    print(f'  original_content freed by the updates: {progress["bytes"]} bytes in {progress["rows"]} rows')
+    for key in ['original_content_bytes', 'toast_bytes', 'heap_bytes', 'dead_tuples', 'live_tuples']:
+        print(f'  {key}: before {before[key]}, after {after[key]}, change {after[key] - before[key]}')
+    # the freed TOAST chunks are reused by new rows but only returned to the
+    # OS by VACUUM FULL or pg_repack, dead tuples are what vacuum still has to reclaim
+    bloat = after['dead_tuples'] / max(after['live_tuples'] + after['dead_tuples'], 1)
+    print(f'  dead tuple ratio after: {bloat:.1%}')
+
+
+def profile_original_content(state):
+    # plan the first batch of the first range, with --profile run it and roll it back
+    conn = connect()
+    try:
+        print_plan('rows with original_content', explain(conn, REMAINING_QUERY))
+        id_range = state['ranges'][0]
+        params = {
+            'lower': id_range['lower'],
+            'upper': id_range['upper'],
+            'first': id_range['after'] is None,
+            'after': id_range['after'],
+            'limit': int(BATCH_SIZE),
+        }
+        print_plan('first batch', explain(conn, BATCH_QUERY, params))
+        if PROFILE:
+            sizes = table_sizes(conn)
+            conn.rollback()
+            sample = explain(conn, BATCH_QUERY, params, analyze=True)
+            print_projection('batch update', sample, int(BATCH_SIZE), sizes['live_tuples'])
+    finally:
+        conn.close()
+
+
+def remove_original_content():
+    state = {'params': {'workers': int(WORKERS)}, 'ranges': split_id_ranges(int(WORKERS))}
+    if WORK_QUEUE:
+        # the queue keeps the progress instead of CURSOR_FILE
+        state = None
+    elif RESUME:
+        saved_state = load_checkpoint(CURSOR_FILE)
+        if saved_state is None:
+            print('No cursor found at', CURSOR_FILE)
+        elif saved_state['params'] != state['params']:
+            raise Exception(f'Cursor {CURSOR_FILE} was written for {saved_state["params"]}')
+        else:
+            print('Resuming from cursor', CURSOR_FILE)
+            state = saved_state
+
+    if DRY_RUN:
+        profile_original_content(state or {'ranges': split_id_ranges(1)})
+        return
+
+    # connection for the measurements and vacuum, which can't run in a transaction
+    conn = connect()
+    conn.autocommit = True
+    metrics.start('remove_original_content')
+    try:
+        before = table_sizes(conn)
+        print('Table sizes before:', before)
+        # the planner's row estimate is enough for an ETA
+        metrics.track_progress('rows_updated', explain(conn, REMAINING_QUERY)['rows'])
+
+        progress = {'lock': threading.Lock(), 'state': state, 'rows': 0, 'bytes': 0, 'batches': 0, 'errors': []}
+        if WORK_QUEUE:
+            queue = WorkQueue(conn, WORK_QUEUE)
+            # every process enqueues the same ranges, ranges already queued are kept
+            queue.enqueue([(id_range['lower'], id_range) for id_range in split_id_ranges(int(WORK_UNITS))])
+            workers = [threading.Thread(target=run_queue_worker, args=(progress,), daemon=True)
+                       for _ in range(int(WORKERS))]
+        else:
+            workers = [threading.Thread(target=run_worker, args=(id_range, progress), daemon=True)
+                       for id_range in state['ranges'] if not id_range['done']]
+        started_at = time.time()
+        vacuumed_at_batch = 0
+        for worker in workers:
+            worker.start()
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=float(PROGRESS_INTERVAL) / len(workers))
+            report_progress(progress, started_at)
+            # vacuum in between batches so the freed TOAST chunks can be reused
+            if int(VACUUM_EVERY) > 0 and progress['batches'] - vacuumed_at_batch >= int(VACUUM_EVERY):
+                vacuumed_at_batch = progress['batches']
+                vacuum_library_item(conn)
+
+        if len(progress['errors']) > 0:
+            raise progress['errors'][0]
+        if WORK_QUEUE:
+            print('Work queue', WORK_QUEUE, queue.summary())
 
+        if FINAL_VACUUM:
+            vacuum_library_item(conn)
+        after = table_sizes(conn)
+        print_summary(before, after, progress)
+    finally:
+        conn.close()
+        metrics.stop()
 
-# postgres connection
-conn = psycopg2.connect(
-    f'host={PG_HOST} port={PG_PORT} dbname={PG_DB} user={PG_USER} \
-    password={PG_PASSWORD} connect_timeout={PG_TIMEOUT}')
-print('Postgres connection:', conn.info)
 
 try:
     print('Starting migration')
-    batch_update_library_items(conn)
+    remove_original_content()
     print('Migration complete')
 except Exception as err:
     print('Migration error', err)
-finally:
-    print('Closing connections')
-    conn.close()